@@ -0,0 +1,115 @@
+import sys
+import os
+# make protocol.py and the server modules importable
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+sys.path.insert(0, os.path.join(parentdir, 'server'))
+# config needs these even though nothing here talks to discord
+os.environ.setdefault('LANG_CHANNEL_ROLE', '0')
+os.environ.setdefault('PL_GUILD_ID', '0')
+
+import contextlib
+import tempfile
+import argparse
+import asyncio
+import time
+
+from websockets.asyncio.client import connect
+import discord
+
+import config
+import protocol
+from client_hook import ClientHookServer
+from discord_cog import LanguageCog
+from gateway import Gateway
+from output import Output
+from store import Store, Language
+
+async def fake_clients(args):
+    # runs in its own process so the bot's cpu time only counts the bot
+    async def client():
+        # connect retries until the server is up
+        async for socket in connect(f'ws://{config.WS_HOST}:{args.port}', max_size=None):
+            register = protocol.SessionRegisterMessage(protocol.new_id(), args.key, 0, args.client_concurrency)
+            register.version = protocol.PROTOCOL_VERSION
+            await socket.send(protocol.encode(register))
+            await socket.recv()
+            stdout = ('x' * 79 + '\n') * (args.output_bytes // 80)
+            async for raw in socket:
+                message = protocol.decode(raw)
+                if message.kind == protocol.EvaluateMessage.kind:
+                    await socket.send(protocol.encode(protocol.ResultMessage(message.id, args.key, True, exit_code=0, stdout=stdout)))
+            return
+    await asyncio.gather(*(client() for _ in range(args.clients)))
+
+async def run(args) -> list[str]:
+    config.WS_PORT = args.port
+    config.GATEWAY_SOCKET = os.path.abspath('gateway.sock')
+    config.MAX_CLIENT_CONCURRENCY = max(config.MAX_CLIENT_CONCURRENCY, args.client_concurrency)
+    config.MAX_CLIENT_CONNECTIONS = max(config.MAX_CLIENT_CONNECTIONS, args.clients)
+    config.MAX_QUEUED_EVALUATIONS = max(config.MAX_QUEUED_EVALUATIONS, args.concurrency)
+    config.EVAL_TIMEOUT_MS = 30000
+
+    store = Store()
+    language = Language(1, 'gateway', 'gw', protocol.new_key())
+    await store.register_lang(language)
+    server = ClientHookServer(store)
+    serving = asyncio.create_task(Gateway(server, args.workers).run() if args.workers > 0 else server.run())
+    cog = LanguageCog(discord.Bot(), server, store)
+    await server.listening.wait()
+    clients = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), '--clients-only', '--key', language.key, '--port', str(args.port),
+                                                   '--clients', str(args.clients), '--client-concurrency', str(args.client_concurrency), '--output-bytes', str(args.output_bytes))
+    while (pool := server.pool(language.key)) is None or len(pool.connections) < args.clients:
+        await asyncio.sleep(0.1)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    async def request(i: int):
+        async with semaphore:
+            await cog.request_evaluation(language, f'print({i})', [], i, Output())
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    await asyncio.gather(*(request(i) for i in range(args.requests)))
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+
+    clients.terminate()
+    await clients.wait()
+    serving.cancel()
+    await asyncio.gather(serving, return_exceptions=True)
+    server.close()
+    store.close()
+    return [
+        f'mode            {"gateway with " + str(args.workers) + " workers" if args.workers > 0 else "websockets in the bot process"}',
+        f'requests        {args.requests} ({args.concurrency} concurrent, {args.clients} connections, {args.output_bytes} bytes of stdout each)',
+        f'throughput      {args.requests / elapsed:,.1f} evaluations/s over {elapsed:.2f}s',
+        f'bot cpu         {cpu:.2f}s, {cpu / args.requests * 1e6:.0f}us per evaluation, {cpu / elapsed:.0%} of one core',
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the bot process\'s cpu time per evaluation with and without gateway workers, the fake clients run in a separate process')
+    parser.add_argument('--workers', type=int, default=0, help='gateway workers, 0 serves the websockets from the bot process')
+    parser.add_argument('-n', '--requests', type=int, default=5000)
+    parser.add_argument('-c', '--concurrency', type=int, default=64)
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--client-concurrency', type=int, default=32)
+    parser.add_argument('--output-bytes', type=int, default=64 * 1024, help='stdout of every RESULT, parsing it is what the workers take off the bot')
+    parser.add_argument('--port', type=int, default=17174)
+    parser.add_argument('--clients-only', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--key', help=argparse.SUPPRESS)
+    parser.add_argument('--verbose', action='store_true', help='keep the server\'s connection logging')
+    args = parser.parse_args()
+
+    if args.clients_only:
+        with contextlib.suppress(KeyboardInterrupt):
+            asyncio.run(fake_clients(args))
+        return
+    # the store writes its database relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix='sandbox-gateway-'))
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+        report = asyncio.run(run(args))
+    print('\n'.join(report))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import sys
+import os
+# make protocol.py and the server modules importable
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+sys.path.insert(0, os.path.join(parentdir, 'server'))
+# config needs these even though nothing here talks to discord
+os.environ.setdefault('LANG_CHANNEL_ROLE', '0')
+os.environ.setdefault('PL_GUILD_ID', '0')
+
+from collections import Counter
+import statistics
+import contextlib
+import tempfile
+import argparse
+import resource
+import asyncio
+import random
+import time
+
+from websockets.asyncio.client import connect
+import discord
+
+import config
+import protocol
+from client_hook import ClientHookServer
+from discord_cog import LanguageCog
+from store import Store, Language
+
+class StubAuthor:
+    def __init__(self, id: int):
+        self.id = id
+
+    def get_role(self, role: int):
+        return None
+
+class StubContext:
+    # records what LanguageCog does with an ApplicationContext instead of talking to discord
+    def __init__(self, user: int):
+        self.author = StubAuthor(user)
+        self.calls: list[tuple[str, float, dict]] = []
+
+    def record(self, name: str, kwargs: dict):
+        self.calls.append((name, time.perf_counter(), kwargs))
+
+    async def defer(self, **kwargs):
+        self.record('defer', kwargs)
+
+    async def respond(self, **kwargs):
+        self.record('respond', kwargs)
+        return self
+
+    async def edit(self, **kwargs):
+        self.record('edit', kwargs)
+
+    @property
+    def outcome(self) -> str:
+        for name, _, kwargs in reversed(self.calls):
+            embed = kwargs.get('embed')
+            if name != 'defer' and embed is not None:
+                return embed.title
+        return 'No response'
+
+    @property
+    def deferred(self) -> bool:
+        return any(name == 'defer' for name, _, _ in self.calls)
+
+async def fake_client(args, key: str, registered: asyncio.Event):
+    # a sandbox client with configurable latency, output size, error and timeout rates
+    async with connect(f'ws://{config.WS_HOST}:{config.WS_PORT}', max_size=None) as socket:
+        encodings = [args.encoding] if args.encoding != 'json' else None
+        register = protocol.SessionRegisterMessage(protocol.new_id(), key, args.cache_ttl, args.client_concurrency, encodings)
+        register.version = protocol.PROTOCOL_VERSION
+        await socket.send(protocol.encode(register))
+        answer = protocol.decode(await socket.recv())
+        assert answer.kind == protocol.ServerOkMessage.kind, f'Registration failed: {answer.to_dict()}'
+        encoding = answer.encoding or 'json'
+        registered.set()
+        line = ('x' * 79 + '\n')
+        running = set()
+
+        async def evaluate(id: str):
+            await asyncio.sleep(max(0.0, random.gauss(args.latency_ms, args.latency_ms * args.jitter) / 1000.0))
+            roll = random.random()
+            if roll < args.timeout_rate:
+                return
+            if roll < args.timeout_rate + args.error_rate:
+                await socket.send(protocol.encode(protocol.ErrorMessage(id, key, 'simulated failure'), encoding))
+                return
+            remaining = args.output_bytes
+            while remaining > 0:
+                chunk = (line * (args.chunk_bytes // len(line) + 1))[:min(args.chunk_bytes, remaining)]
+                remaining -= len(chunk)
+                await socket.send(protocol.encode(protocol.OutputChunkMessage(id, key, 'stdout', chunk), encoding))
+            await socket.send(protocol.encode(protocol.ResultMessage(id, key, True, exit_code=0), encoding))
+
+        async for raw in socket:
+            message = protocol.decode(raw)
+            if message.kind == protocol.EvaluateMessage.kind:
+                task = asyncio.create_task(evaluate(message.id))
+                running.add(task)
+                task.add_done_callback(running.discard)
+
+def rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+async def run(args) -> list[str]:
+    config.WS_PORT = args.port
+    config.EVAL_TIMEOUT_MS = args.eval_timeout_ms
+    # the harness measures the server, not the per user rate limit
+    config.EVAL_RATE_BURST = args.requests + 1
+    config.MAX_CLIENT_CONCURRENCY = max(config.MAX_CLIENT_CONCURRENCY, args.client_concurrency)
+    config.MAX_CLIENT_CONNECTIONS = max(config.MAX_CLIENT_CONNECTIONS, args.clients)
+    config.MAX_QUEUED_EVALUATIONS = max(config.MAX_QUEUED_EVALUATIONS, args.concurrency)
+
+    store = Store()
+    key = protocol.new_key()
+    await store.register_lang(Language(1, 'loadtest', 'lt', key))
+    server = ClientHookServer(store)
+    server_task = asyncio.create_task(server.run())
+    cog = LanguageCog(discord.Bot(), server, store)
+    await asyncio.sleep(0.2)
+    registered = [asyncio.Event() for _ in range(args.clients)]
+    clients = [asyncio.create_task(fake_client(args, key, event)) for event in registered]
+    await asyncio.wait_for(asyncio.gather(*(event.wait() for event in registered)), 10)
+
+    contexts: list[StubContext] = []
+    latencies: list[float] = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+    snippets = max(1, args.distinct_snippets)
+
+    async def request(i: int):
+        async with semaphore:
+            ctx = StubContext(i % args.users)
+            contexts.append(ctx)
+            start = time.perf_counter()
+            await cog.evaluate(ctx, 'loadtest', f'print({i % snippets})', True)
+            latencies.append(time.perf_counter() - start)
+
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    await asyncio.gather(*(request(i) for i in range(args.requests)))
+    elapsed = time.perf_counter() - start
+    rss_after = rss_bytes()
+
+    for client in clients:
+        client.cancel()
+    await asyncio.gather(*clients, return_exceptions=True)
+    server_task.cancel()
+    await asyncio.gather(server_task, return_exceptions=True)
+    server.close()
+    store.close()
+
+    outcomes = Counter(ctx.outcome for ctx in contexts)
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    report = [
+        f'requests        {args.requests} ({args.concurrency} concurrent, {args.clients} connections x {args.client_concurrency})',
+        f'throughput      {args.requests / elapsed:,.1f} evaluations/s over {elapsed:.2f}s',
+        f'latency         p50 {percentiles[49] * 1000:.1f}ms  p95 {percentiles[94] * 1000:.1f}ms  p99 {percentiles[98] * 1000:.1f}ms  max {max(latencies) * 1000:.1f}ms',
+        f'deferred        {sum(ctx.deferred for ctx in contexts)}',
+        f'timeout rate    {outcomes["Client timeout"] / args.requests:.2%}',
+        f'memory          {rss_before / 2**20:.1f}MiB -> {rss_after / 2**20:.1f}MiB ({(rss_after - rss_before) / 2**20:+.1f}MiB)',
+        f'cache           {cog.cache.hits} hits, {cog.cache.coalesced} coalesced, {cog.cache.misses} misses',
+    ]
+    report += [f'  {count:>7}  {outcome}' for outcome, count in outcomes.most_common()]
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the client hook server on localhost and drives LanguageCog.evaluate against fake sandbox clients')
+    parser.add_argument('-n', '--requests', type=int, default=2000)
+    parser.add_argument('-c', '--concurrency', type=int, default=100, help='evaluations in flight at once')
+    parser.add_argument('--users', type=int, default=50, help='distinct discord users the requests come from')
+    parser.add_argument('--clients', type=int, default=4, help='websocket connections of the fake client')
+    parser.add_argument('--client-concurrency', type=int, default=16, help='max_concurrency each connection registers with')
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--jitter', type=float, default=0.25, help='standard deviation of the latency relative to its mean')
+    parser.add_argument('--output-bytes', type=int, default=2048, help='stdout produced per evaluation')
+    parser.add_argument('--chunk-bytes', type=int, default=1024, help='size of each OUTPUT_CHUNK')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='share of evaluations the client never answers')
+    parser.add_argument('--eval-timeout-ms', type=int, default=2000)
+    parser.add_argument('--cache-ttl', type=int, default=0, help='cache_ttl the clients register with, 0 disables the cache')
+    parser.add_argument('--distinct-snippets', type=int, default=1000000, help='number of different snippets, lower values exercise the cache')
+    parser.add_argument('--encoding', choices=('json', 'msgpack'), default='json')
+    parser.add_argument('--port', type=int, default=17170)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--verbose', action='store_true', help='keep the server\'s connection logging')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    # the store writes its database relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix='sandbox-loadtest-'))
+    # the server logs every connection, the report is printed once the run is over
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+        report = asyncio.run(run(args))
+    print('\n'.join(report))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+import sys
+import os
+# make protocol.py importable
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import argparse
+import json
+import time
+
+import protocol
+
+# the codec before this one, only version 0 and the messages it knew
+import baseline_protocol
+
+def samples(stdout_size: int) -> list[tuple[str, object|None, object]]:
+    # the baseline has no OUTPUT_CHUNK, that row only measures the current codec
+    id = protocol.new_id()
+    key = protocol.new_key()
+    code = 'print("hello world")\n' * 4
+    stdout = ('x' * 79 + '\n') * (stdout_size // 80)
+    return [
+        ('evaluate', baseline_protocol.EvaluateMessage(id, code), protocol.EvaluateMessage(id, code)),
+        ('output chunk', None, protocol.OutputChunkMessage(id, key, 'stdout', 'line of output\n')),
+        ('exit code only', baseline_protocol.ResultMessage(id, key, True, exit_code=0), protocol.ResultMessage(id, key, True, exit_code=0)),
+        ('small result', baseline_protocol.ResultMessage(id, key, True, exit_code=0, stdout='ok\n'), protocol.ResultMessage(id, key, True, exit_code=0, stdout='ok\n')),
+        (f'{stdout_size // 1024}KiB result', baseline_protocol.ResultMessage(id, key, True, exit_code=0, stdout=stdout), protocol.ResultMessage(id, key, True, exit_code=0, stdout=stdout)),
+    ]
+
+def measure(iterations: int, function) -> float:
+    # returns operations per second
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return iterations / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares encode and decode throughput of the protocol codecs')
+    parser.add_argument('-n', '--iterations', type=int, default=20000)
+    parser.add_argument('--stdout-size', type=int, default=64 * 1024, help='size of the large result in bytes')
+    args = parser.parse_args()
+
+    print(f'{"message":<16} {"codec":<8} {"encode/s":>12} {"decode/s":>12} {"bytes":>10}')
+    for name, baseline, message in samples(args.stdout_size):
+        iterations = max(args.iterations * 80 // max(len(json.dumps(message.to_dict())), 80), 100)
+        if baseline is not None:
+            raw = json.dumps(baseline.to_dict())
+            print(f'{name:<16} {"baseline":<8} {measure(iterations, lambda: json.dumps(baseline.to_dict())):>12,.0f} {measure(iterations, lambda: baseline_protocol.Message.from_dict(json.loads(raw))):>12,.0f} {len(raw):>10}')
+        for encoding in protocol.ENCODINGS:
+            raw = protocol.encode(message, encoding)
+            print(f'{name:<16} {encoding:<8} {measure(iterations, lambda: protocol.encode(message, encoding)):>12,.0f} {measure(iterations, lambda: protocol.decode(raw)):>12,.0f} {len(raw):>10}')
+    if 'msgpack' not in protocol.ENCODINGS:
+        print('msgpack is not installed, only json was measured')
+
+if __name__ == '__main__':
+    main()
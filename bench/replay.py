@@ -0,0 +1,206 @@
+import sys
+import os
+# make protocol.py and the server modules importable
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+sys.path.insert(0, os.path.join(parentdir, 'server'))
+# config needs these even though nothing here talks to discord
+os.environ.setdefault('LANG_CHANNEL_ROLE', '0')
+os.environ.setdefault('PL_GUILD_ID', '0')
+
+from collections import Counter
+import statistics
+import contextlib
+import tempfile
+import argparse
+import asyncio
+import gzip
+import json
+import time
+
+from websockets.asyncio.client import connect
+import discord
+
+import config
+import protocol
+from client_hook import ClientHookServer
+from discord_cog import LanguageCog
+from store import Store, Language
+from load_test import StubContext, rss_bytes
+
+# what the server sends to start a conversation and what the client answers with
+STARTS = (protocol.EvaluateChunkMessage.kind, protocol.EvaluateMessage.kind)
+ANSWERS = (protocol.OutputChunkMessage.kind, protocol.ResultMessage.kind, protocol.ErrorMessage.kind)
+FINAL = (protocol.ResultMessage.kind, protocol.ErrorMessage.kind)
+
+class Exchange:
+    # one recorded conversation, the client's answers are relative to the server's first message
+    def __init__(self, start: float):
+        self.start = start
+        self.code_size = 0
+        self.code: str|None = None
+        self.replies: list[tuple[float, str, int, dict|None]] = []
+        self.finished: float|None = None
+
+    @property
+    def recorded_latency(self) -> float|None:
+        return None if self.finished is None else self.finished - self.start
+
+def read_trace(paths: list[str]) -> list[dict]:
+    entries = []
+    for path in sorted(paths):
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            try:
+                for line in file:
+                    entries.append(json.loads(line))
+            except (EOFError, ValueError):
+                # the last batch of a trace whose server did not shut down cleanly
+                print(f'{path} ends early, replaying what was readable')
+    return entries
+
+def exchanges(entries: list[dict]) -> tuple[list[Exchange], int]:
+    found: dict[str, Exchange] = {}
+    skipped = set()
+    for entry in entries:
+        id, kind = entry['id'], entry['kind']
+        if entry['dir'] == 'out':
+            if kind == protocol.EvaluateBatchMessage.kind:
+                skipped.add(id)
+            elif kind in STARTS:
+                exchange = found.setdefault(id, Exchange(entry['t']))
+                exchange.code_size += entry['size']
+                message = entry.get('message')
+                if message is not None and kind == protocol.EvaluateMessage.kind and not message.get('chunked', False):
+                    exchange.code = message['code']
+        elif kind in ANSWERS and id in found and found[id].finished is None:
+            exchange = found[id]
+            exchange.replies.append((entry['t'] - exchange.start, kind, entry['size'], entry.get('message')))
+            if kind in FINAL:
+                exchange.finished = entry['t']
+    return sorted(found.values(), key=lambda exchange: exchange.start), len(skipped)
+
+async def fake_client(args, key: str, script: list[Exchange], registered: asyncio.Event):
+    # answers every evaluation the way the recorded client answered the same exchange
+    async with connect(f'ws://{config.WS_HOST}:{config.WS_PORT}', max_size=None) as socket:
+        register = protocol.SessionRegisterMessage(protocol.new_id(), key, 0, args.client_concurrency)
+        register.version = protocol.PROTOCOL_VERSION
+        await socket.send(protocol.encode(register))
+        answer = protocol.decode(await socket.recv())
+        assert answer.kind == protocol.ServerOkMessage.kind, f'Registration failed: {answer.to_dict()}'
+        registered.set()
+        envelope = len(protocol.encode(protocol.OutputChunkMessage(protocol.new_id(), key, 'stdout', '')))
+        running = set()
+
+        async def reply(id: str, exchange: Exchange):
+            elapsed = 0.0
+            for offset, kind, size, recorded in exchange.replies:
+                await asyncio.sleep(max(0.0, offset / args.speed - elapsed))
+                elapsed = offset / args.speed
+                if recorded is not None:
+                    # traces leave out the key
+                    message = protocol.Message.from_dict(dict(recorded, id=id, key=key))
+                elif kind == protocol.OutputChunkMessage.kind:
+                    message = protocol.OutputChunkMessage(id, key, 'stdout', 'x' * max(0, size - envelope))
+                elif kind == protocol.ErrorMessage.kind:
+                    message = protocol.ErrorMessage(id, key, 'replayed error')
+                else:
+                    message = protocol.ResultMessage(id, key, True, exit_code=0)
+                await socket.send(protocol.encode(message))
+
+        async for raw in socket:
+            message = protocol.decode(raw)
+            if message.kind == protocol.EvaluateMessage.kind:
+                # the replayed code starts with the index of its exchange
+                index = int(message.code.split('\n', 1)[0].removeprefix('#replay '))
+                task = asyncio.create_task(reply(message.id, script[index]))
+                running.add(task)
+                task.add_done_callback(running.discard)
+
+async def run(args) -> list[str]:
+    entries = read_trace(args.trace)
+    script, skipped = exchanges(entries)
+    if len(script) == 0:
+        return ['no evaluations in the trace']
+    config.WS_PORT = args.port
+    config.EVAL_TIMEOUT_MS = args.eval_timeout_ms
+    # the fake client reads the exchange index from the EVALUATE, so code is never sent in chunks
+    config.EVAL_CHUNK_CHARS = max(config.EVAL_CHUNK_CHARS, max(exchange.code_size for exchange in script) + 64)
+    config.EVAL_RATE_BURST = len(script) + 1
+    config.MAX_CLIENT_CONCURRENCY = max(config.MAX_CLIENT_CONCURRENCY, args.client_concurrency)
+    config.MAX_QUEUED_EVALUATIONS = max(config.MAX_QUEUED_EVALUATIONS, len(script))
+
+    store = Store()
+    key = protocol.new_key()
+    await store.register_lang(Language(1, 'replay', 'rp', key))
+    server = ClientHookServer(store)
+    server_task = asyncio.create_task(server.run())
+    cog = LanguageCog(discord.Bot(), server, store)
+    await asyncio.sleep(0.2)
+    registered = asyncio.Event()
+    client = asyncio.create_task(fake_client(args, key, script, registered))
+    await asyncio.wait_for(registered.wait(), 10)
+
+    contexts: list[StubContext] = []
+    latencies: list[float] = []
+    first = script[0].start
+
+    async def request(index: int, exchange: Exchange):
+        await asyncio.sleep(max(0.0, (exchange.start - first) / args.speed - (time.perf_counter() - start)))
+        ctx = StubContext(index % args.users)
+        contexts.append(ctx)
+        code = exchange.code if exchange.code is not None else 'x' * exchange.code_size
+        began = time.perf_counter()
+        await cog.evaluate(ctx, 'replay', f'#replay {index}\n{code}', True)
+        latencies.append(time.perf_counter() - began)
+
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    await asyncio.gather(*(request(index, exchange) for index, exchange in enumerate(script)))
+    elapsed = time.perf_counter() - start
+    rss_after = rss_bytes()
+
+    client.cancel()
+    await asyncio.gather(client, return_exceptions=True)
+    server_task.cancel()
+    await asyncio.gather(server_task, return_exceptions=True)
+    store.close()
+
+    def percentiles(values: list[float]) -> str:
+        if len(values) == 0:
+            return '-'
+        points = statistics.quantiles(values, n=100, method='inclusive') if len(values) > 1 else values * 99
+        return f'p50 {points[49] * 1000:.1f}ms  p95 {points[94] * 1000:.1f}ms  p99 {points[98] * 1000:.1f}ms'
+
+    recorded = [exchange.recorded_latency / args.speed for exchange in script if exchange.recorded_latency is not None]
+    outcomes = Counter(ctx.outcome for ctx in contexts)
+    report = [
+        f'trace           {len(entries)} frames, {len(script)} evaluations replayed, {skipped} batches skipped',
+        f'duration        {(script[-1].start - first) / args.speed:.2f}s scheduled at {args.speed}x, {elapsed:.2f}s taken',
+        f'recorded        {percentiles(recorded)} (client time, scaled)',
+        f'replayed        {percentiles(latencies)}',
+        f'memory          {rss_before / 2**20:.1f}MiB -> {rss_after / 2**20:.1f}MiB ({(rss_after - rss_before) / 2**20:+.1f}MiB)',
+    ]
+    report += [f'  {count:>7}  {outcome}' for outcome, count in outcomes.most_common()]
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays a trace recorded with TRACE_PATH against the client hook server and a fake client on localhost')
+    parser.add_argument('trace', nargs='+', help='trace files, rotated parts of one recording are replayed in order')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay faster than recorded, i.e. 10 for 10x')
+    parser.add_argument('--users', type=int, default=50, help='distinct discord users the requests come from')
+    parser.add_argument('--client-concurrency', type=int, default=64, help='max_concurrency the fake client registers with')
+    parser.add_argument('--eval-timeout-ms', type=int, default=config.EVAL_TIMEOUT_MS)
+    parser.add_argument('--port', type=int, default=17172)
+    parser.add_argument('--verbose', action='store_true', help='keep the server\'s connection logging')
+    args = parser.parse_args()
+    args.trace = [os.path.abspath(path) for path in args.trace]
+
+    # the store writes its database relative to the working directory
+    os.chdir(tempfile.mkdtemp(prefix='sandbox-replay-'))
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+        report = asyncio.run(run(args))
+    print('\n'.join(report))
+
+if __name__ == '__main__':
+    main()
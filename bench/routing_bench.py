@@ -0,0 +1,98 @@
+import sys
+import os
+# make protocol.py and the server modules importable
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+sys.path.insert(0, os.path.join(parentdir, 'server'))
+# config needs these even though nothing here talks to discord
+os.environ.setdefault('LANG_CHANNEL_ROLE', '0')
+os.environ.setdefault('PL_GUILD_ID', '0')
+
+import argparse
+import asyncio
+import time
+
+import config
+import protocol
+from client_hook import ClientHookServer
+from store import Language
+
+class AcceptingStore:
+    def find_by_key(self, key: str) -> Language:
+        return Language(0, 'bench', 'bench', key)
+
+class LoopbackSocket:
+    # stands in for a client connection, answers every evaluation with output chunks and a result
+    def __init__(self, key: str, chunks: int):
+        self.key = key
+        self.chunks = chunks
+        self.remote_address = ('bench', 0)
+        self.incoming: asyncio.Queue = asyncio.Queue()
+        register = protocol.SessionRegisterMessage(protocol.new_id(), key, 0, config.MAX_CLIENT_CONCURRENCY)
+        register.version = protocol.PROTOCOL_VERSION
+        self.incoming.put_nowait(protocol.encode(register))
+        self.registered = asyncio.Event()
+
+    async def send(self, raw: str):
+        message = protocol.decode(raw)
+        if message.kind == protocol.ServerOkMessage.kind:
+            self.registered.set()
+        elif message.kind == protocol.EvaluateMessage.kind:
+            for i in range(self.chunks):
+                self.incoming.put_nowait(protocol.encode(protocol.OutputChunkMessage(message.id, self.key, 'stdout', f'line {i}\n')))
+            self.incoming.put_nowait(protocol.encode(protocol.ResultMessage(message.id, self.key, True, exit_code=0)))
+
+    async def close(self):
+        self.incoming.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        raw = await self.incoming.get()
+        if raw is None:
+            raise StopAsyncIteration()
+        return raw
+
+async def converse(server: ClientHookServer, key: str) -> int:
+    convo = await server.conversation(key)
+    received = 0
+    async with convo:
+        await convo.send(protocol.EvaluateMessage(convo.id, 'print(1)'))
+        while True:
+            message = await convo.receive()
+            received += 1
+            if message.kind != protocol.OutputChunkMessage.kind:
+                return received
+
+async def run(conversations: int, rounds: int, chunks: int):
+    config.MAX_CLIENT_CONCURRENCY = conversations
+    config.MAX_QUEUED_EVALUATIONS = conversations
+    server = ClientHookServer(AcceptingStore())
+    key = protocol.new_key()
+    socket = LoopbackSocket(key, chunks)
+    handler = asyncio.ensure_future(server.handle_client(socket))
+    await socket.registered.wait()
+    messages = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        messages += sum(await asyncio.gather(*(converse(server, key) for _ in range(conversations))))
+    elapsed = time.perf_counter() - start
+    open_conversations = sum(len(client.conversations) for client in server.clients[key].connections)
+    await socket.close()
+    await handler
+    print(f'{conversations} concurrent conversations, {rounds} rounds, {chunks} chunks each')
+    print(f'{messages:,} messages routed in {elapsed:.2f}s, {messages / elapsed:,.0f} messages/s')
+    print(f'{open_conversations} conversations left open')
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures how many client messages per second ClientHookServer routes to their conversations')
+    parser.add_argument('-c', '--conversations', type=int, default=5000)
+    parser.add_argument('-r', '--rounds', type=int, default=5)
+    parser.add_argument('--chunks', type=int, default=4, help='output chunks sent before each result')
+    args = parser.parse_args()
+    asyncio.run(run(args.conversations, args.rounds, args.chunks))
+
+if __name__ == '__main__':
+    main()
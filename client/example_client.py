@@ -22,7 +22,7 @@ def evaluate(code: str):
 async def client():
     async with connect("ws://localhost:1717") as socket:
         print('registring...')
-        # register
+        # register, the default version 0 means code always arrives in a single EVALUATE
         m = protocol.SessionRegisterMessage(protocol.new_id(), CLIENT_KEY)
         await socket.send(json.dumps(m.to_dict()))
         # wait for ServerOk
@@ -40,9 +40,17 @@ async def client():
             print('waiting for server message...')
             r = await socket.recv()
             m: protocol.EvaluateMessage = protocol.Message.from_dict(json.loads(r))
-            assert m.kind == protocol.EvaluateMessage.kind, f'Invalid message of kind {m.kind}:\n{m.to_dict()}'
+            if m.kind != protocol.EvaluateMessage.kind:
+                # i.e. a TIMEOUT for an evaluation that already finished, see runtime.py for a client that can cancel evaluations
+                print(f'ignoring message of kind {m.kind}')
+                continue
             print('received code to evaluate')
             conversation_id = m.id
+            if m.chunked:
+                # only sent to clients registering with version 2 or later, see runtime.py for reassembling chunks
+                m = protocol.ErrorMessage(conversation_id, CLIENT_KEY, 'This client does not support chunked input')
+                await socket.send(json.dumps(m.to_dict()))
+                continue
             # we only care about stdout
             result = evaluate(m.code)
             print('evaluated, sendign response...')
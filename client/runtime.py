@@ -0,0 +1,308 @@
+import sys
+import os
+# make protocol.py importable
+currentdir = os.path.dirname(os.path.abspath(__file__))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+from websockets.asyncio.client import connect, ClientConnection
+from websockets.exceptions import ConnectionClosed
+from collections import deque
+import tempfile
+import argparse
+import asyncio
+import codecs
+import random
+import shutil
+import signal
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import protocol
+
+class Limits:
+    # applied to every worker process, None leaves the limit untouched
+    def __init__(self, cpu_seconds: int|None = None, memory_bytes: int|None = None):
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_bytes
+
+    def apply(self):
+        # runs in the child between fork and exec
+        if self.cpu_seconds is not None:
+            resource.setrlimit(resource.RLIMIT_CPU, (self.cpu_seconds, self.cpu_seconds))
+        if self.memory_bytes is not None:
+            resource.setrlimit(resource.RLIMIT_AS, (self.memory_bytes, self.memory_bytes))
+
+class Worker:
+    # a started interpreter waiting for its program on stdin, used for a single evaluation
+    def __init__(self, process: asyncio.subprocess.Process, directory: str):
+        self.process = process
+        self.directory = directory
+
+    def kill(self):
+        if self.process.returncode is None:
+            try:
+                # the worker runs in its own session, this also takes down anything it spawned
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+class WorkerPool:
+    # keeps `size` workers started ahead of time so evaluations do not pay for interpreter startup
+    def __init__(self, command: list[str], size: int, limits: Limits):
+        self.command = command
+        self.size = size
+        self.limits = limits
+        self.idle: asyncio.Queue[Worker] = asyncio.Queue()
+        self.spawning: set[asyncio.Task] = set()
+
+    def start(self):
+        for _ in range(self.size):
+            self.respawn()
+
+    async def spawn(self) -> Worker:
+        directory = tempfile.mkdtemp(prefix='sandbox-worker-')
+        limits = self.limits.apply if resource is not None else None
+        process = await asyncio.create_subprocess_exec(*self.command, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                       cwd=directory, preexec_fn=limits, start_new_session=True)
+        return Worker(process, directory)
+
+    def respawn(self):
+        async def refill():
+            try:
+                self.idle.put_nowait(await self.spawn())
+            except OSError as e:
+                print(f'Could not start worker: {e}')
+                await asyncio.sleep(1)
+                self.respawn()
+        task = asyncio.create_task(refill())
+        self.spawning.add(task)
+        task.add_done_callback(self.spawning.discard)
+
+    async def acquire(self) -> Worker:
+        worker = await self.idle.get()
+        if worker.process.returncode is not None:
+            # died while idle, e.g. the interpreter crashed on startup
+            worker.kill()
+            self.respawn()
+            return await self.acquire()
+        return worker
+
+    def release(self, worker: Worker):
+        # workers are never reused, whatever the program did is thrown away with them
+        worker.kill()
+        self.respawn()
+
+    def close(self):
+        for task in self.spawning:
+            task.cancel()
+        while not self.idle.empty():
+            self.idle.get_nowait().kill()
+
+class Runtime:
+    def __init__(self, key: str, command: list[str], url: str = 'ws://localhost:1717', workers: int = 4, limits: Limits|None = None, cache_ttl: int|None = None):
+        self.key = key
+        self.url = url
+        self.cache_ttl = cache_ttl
+        self.pool = WorkerPool(command, workers, limits or Limits())
+        # conversation id -> running evaluation, a TIMEOUT cancels it and with it the worker
+        self.running: dict[str, asyncio.Task] = {}
+        # inputs and files sent as EVALUATE_CHUNKs, collected until their EVALUATE arrives
+        self.chunks: dict[str, tuple[list[str], dict[str, list[str]]]] = {}
+        self.socket: ClientConnection|None = None
+        self.encoding = 'json'
+        # resumes the session after a reconnect, running evaluations then answer over the new connection
+        self.session: str|None = None
+        # messages that could not be sent while disconnected, flushed once the session is resumed
+        self.outbox: deque[protocol.ClientMessage] = deque()
+
+    async def run_forever(self, backoff: float = 0.5, max_backoff: float = 30.0):
+        # reconnects with full jitter so a restarted server is not hit by every client at once
+        self.pool.start()
+        attempt = 0
+        try:
+            while True:
+                try:
+                    async with connect(self.url) as socket:
+                        await self.register(socket)
+                        attempt = 0
+                        await self.serve(socket)
+                except (OSError, ConnectionClosed) as e:
+                    print(f'Connection lost: {e}')
+                delay = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+                attempt += 1
+                print(f'Reconnecting in {delay:.1f}s')
+                await asyncio.sleep(delay)
+        finally:
+            # evaluations release their workers when cancelled, the pool kills the idle ones
+            running = list(self.running.values())
+            self.cancel_running()
+            await asyncio.gather(*running, return_exceptions=True)
+            self.pool.close()
+
+    async def register(self, socket: ClientConnection):
+        message = protocol.SessionRegisterMessage(protocol.new_id(), self.key, self.cache_ttl, self.pool.size, list(protocol.ENCODINGS), self.session)
+        # the runtime handles everything up to the latest version
+        message.version = protocol.PROTOCOL_VERSION
+        await socket.send(protocol.encode(message))
+        answer = protocol.decode(await socket.recv())
+        if answer.kind != protocol.ServerOkMessage.kind:
+            error = getattr(answer, 'error', None) or ''
+            if error.startswith('Too many registrations'):
+                raise ConnectionError(error)
+            # retrying will not fix an invalid key
+            raise ValueError(f'Registration failed: {error}')
+        resumed = self.session is not None and answer.session == self.session
+        if not resumed:
+            # the server failed the old conversations already, their results have nowhere to go
+            self.cancel_running()
+        self.session = answer.session
+        self.encoding = answer.encoding or 'json'
+        # sends keep going to the outbox until it is empty, so results stay in order
+        while len(self.outbox) > 0:
+            await socket.send(protocol.encode(self.outbox[0], self.encoding))
+            self.outbox.popleft()
+        self.socket = socket
+        print('Resumed session' if resumed else 'Registered')
+
+    def cancel_running(self):
+        for task in list(self.running.values()):
+            task.cancel()
+        self.chunks.clear()
+        self.outbox.clear()
+
+    async def serve(self, socket: ClientConnection):
+        try:
+            async for raw in socket:
+                try:
+                    message = protocol.decode(raw)
+                except ValueError as e:
+                    print(f'Invalid message from server: {e}')
+                    continue
+                match message.kind:
+                    case protocol.EvaluateChunkMessage.kind:
+                        code, files = self.chunks.setdefault(message.id, ([], {}))
+                        if message.file is None:
+                            code.append(message.data)
+                        else:
+                            files.setdefault(message.file, []).append(message.data)
+                    case protocol.EvaluateMessage.kind:
+                        code, files = self.chunks.pop(message.id, ([], {}))
+                        self.start(message.id, self.evaluate(message.id, ''.join(code) if message.chunked else message.code, { name: ''.join(parts) for name, parts in files.items() }))
+                    case protocol.EvaluateBatchMessage.kind:
+                        self.start(message.id, self.evaluate_batch(message.id, message.codes))
+                    case protocol.TimeoutMessage.kind:
+                        task = self.running.get(message.id)
+                        if task is not None:
+                            task.cancel()
+                    case protocol.InvalidMessage.kind:
+                        print(f'Server rejected message {message.id}: {message.error}')
+        finally:
+            self.socket = None
+            if self.session is None:
+                # without a session evaluations cannot answer over a new connection, the server has failed them already
+                self.cancel_running()
+
+    def start(self, id: str, evaluation):
+        task = asyncio.create_task(evaluation)
+        self.running[id] = task
+        task.add_done_callback(lambda _: self.running.pop(id, None))
+
+    async def send(self, message: protocol.ClientMessage):
+        message.version = protocol.PROTOCOL_VERSION
+        while self.socket is not None:
+            socket = self.socket
+            try:
+                await socket.send(protocol.encode(message, self.encoding))
+                return
+            except ConnectionClosed:
+                if self.socket is socket:
+                    break
+        # kept for a resumed session, without one the server fails the conversation on its own
+        if self.session is not None:
+            self.outbox.append(message)
+
+    async def evaluate(self, id: str, code: str, files: dict[str, str]):
+        try:
+            result = await self.execute(id, code, files, stream=True)
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            await self.send(protocol.ErrorMessage(id, self.key, str(e)))
+            return
+        await self.send(result)
+
+    async def evaluate_batch(self, id: str, codes: list[str]):
+        # the server counts a batch as one evaluation, so its blocks take turns on a single worker slot
+        try:
+            results = [await self.execute(id, code, {}, stream=False) for code in codes]
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            await self.send(protocol.ErrorMessage(id, self.key, str(e)))
+            return
+        await self.send(protocol.BatchResultMessage(id, self.key, results))
+
+    async def execute(self, id: str, code: str, files: dict[str, str], stream: bool) -> protocol.ResultMessage:
+        worker = await self.pool.acquire()
+        try:
+            for name, content in files.items():
+                path = os.path.join(worker.directory, os.path.basename(name))
+                with open(path, 'w') as file:
+                    file.write(content)
+            process = worker.process
+            # a program that exits without reading its input must not fail the evaluation
+            try:
+                process.stdin.write(code.encode())
+                await process.stdin.drain()
+                process.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            collected = { 'stdout': [], 'stderr': [] }
+            async def pump(name: str, reader: asyncio.StreamReader):
+                decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+                while True:
+                    data = await reader.read(64 * 1024)
+                    text = decoder.decode(data, final=len(data) == 0)
+                    if len(text) > 0:
+                        if stream:
+                            await self.send(protocol.OutputChunkMessage(id, self.key, name, text))
+                        else:
+                            collected[name].append(text)
+                    if len(data) == 0:
+                        return
+            await asyncio.gather(pump('stdout', process.stdout), pump('stderr', process.stderr))
+            exit_code = await process.wait()
+        finally:
+            # also runs when a TIMEOUT cancelled the evaluation, killing the worker frees its CPU right away
+            self.pool.release(worker)
+        if stream:
+            return protocol.ResultMessage(id, self.key, True, exit_code=exit_code)
+        # empty output is left out of the message like the streamed results do
+        return protocol.ResultMessage(id, self.key, True, exit_code=exit_code, stdout=''.join(collected['stdout']) or None, stderr=''.join(collected['stderr']) or None)
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs a sandbox client that pipes every snippet into a fresh process of the given command')
+    parser.add_argument('command', nargs='+', help='interpreter that reads the program from stdin, e.g. `python3 -`')
+    parser.add_argument('--url', default='ws://localhost:1717')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='evaluations run at once, each on a prewarmed process')
+    parser.add_argument('--cpu-seconds', type=int, default=None, help='CPU time limit of each run')
+    parser.add_argument('--memory-mb', type=int, default=None, help='address space limit of each run')
+    parser.add_argument('--cache-ttl', type=int, default=None, help='how long the server may cache results in milliseconds, 0 for languages that are not deterministic')
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    key = os.getenv('CLIENT_KEY')
+    if key is None:
+        parser.error('CLIENT_KEY is not set, put the key obtained by /client_key in .env')
+    limits = Limits(args.cpu_seconds, None if args.memory_mb is None else args.memory_mb * 1024 * 1024)
+    runtime = Runtime(key, args.command, args.url, args.workers, limits, args.cache_ttl)
+    asyncio.run(runtime.run_forever())
+
+if __name__ == '__main__':
+    main()
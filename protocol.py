@@ -1,181 +1,269 @@
-from uuid import uuid4
+from uuid import UUID
+from random import getrandbits
 from os import urandom
 import base64
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# version 1 adds streamed output via OutputChunkMessage
+# version 2 adds chunked input and attached files via EvaluateChunkMessage
+# version 3 adds batched evaluation via EvaluateBatchMessage and BatchResultMessage
+# version 4 adds negotiating a binary encoding on registration
+PROTOCOL_VERSION = 5
+SUPPORTED_VERSIONS = (0, 1, 2, 3, 4, 5)
+
+# in order of preference, json is always available
+ENCODINGS = ('msgpack', 'json') if msgpack is not None else ('json',)
 
 def new_id() -> str:
-    return str(uuid4())
+    # a version 4 uuid without the urandom syscall of uuid4, ids only need to be unique and not secret
+    return str(UUID(int=getrandbits(128), version=4))
 
 def new_key() -> str:
     return base64.b64encode(urandom(64)).decode()
 
+# marks a missing key, optional fields are usually missing and a lookup with a default is cheaper than a KeyError
+MISSING = object()
+
 def get_value(data: dict, name: str, ty: type, optional: bool):
-    if name not in data:
+    value = data.get(name, MISSING)
+    if value is MISSING:
         if optional:
             return None
         raise ValueError(f'Key {name} not defined')
-    if type(data[name]) != ty:
-        raise ValueError(f'Expected value of {name} to be of type {ty.__name__}, got {type(data[name]).__name__}')
-    return data[name]
+    if type(value) is not ty:
+        raise ValueError(f'Expected value of {name} to be of type {ty.__name__}, got {type(value).__name__}')
+    return value
+
+def get_list(data: dict, name: str, ty: type, optional: bool):
+    values = get_value(data, name, list, optional)
+    if values is not None:
+        for value in values:
+            if type(value) is not ty:
+                raise ValueError(f'Expected value of {name} to be a list of {ty.__name__}, got {type(value).__name__} in list')
+    return values
+
+# json.dumps builds a new encoder whenever it is given options, this one is reused for every frame
+json_encoder = json.JSONEncoder(separators=(',', ':'))
+json_decoder = json.JSONDecoder()
+
+def encode(message: 'Message', encoding: str = 'json') -> str|bytes:
+    if encoding == 'msgpack':
+        return msgpack.packb(message.to_dict())
+    return json_encoder.encode(message.to_dict())
+
+def decode(raw: str|bytes) -> 'Message':
+    return Message.from_dict(parse(raw))
+
+def parse(raw: str|bytes) -> dict:
+    # text frames are json, binary frames msgpack
+    if isinstance(raw, str):
+        data = json_decoder.decode(raw)
+    elif msgpack is None:
+        raise ValueError('Binary messages need msgpack, which is not installed')
+    else:
+        try:
+            data = msgpack.unpackb(raw)
+        except Exception as e:
+            raise ValueError(f'Invalid msgpack message: {e}')
+    if type(data) is not dict:
+        raise ValueError(f'Expected an object, got {type(data).__name__}')
+    return data
 
 class Message:
-    def __init__(self, id: str, kind: str, side: str):
+    __slots__ = ('id', 'version')
+    kind = ''
+    side = ''
+
+    def __init__(self, id: str):
         self.id = id
+        # clients opt into newer versions explicitly, the server uses only what a client registered with
         self.version = 0
-        self.kind = kind
-        self.side = side
 
     def to_dict(self) -> dict:
-        return { 
-            'id': self.id, 
-            'version': self.version, 
-            'kind': self.kind, 
+        return {
+            'id': self.id,
+            'version': self.version,
+            'kind': self.kind,
             'side': self.side
         }
 
     def from_dict(data: dict) -> 'Message':
         id = get_value(data, 'id', str, False)
         version = get_value(data, 'version', int, False)
-        if version != 0:
-            raise ValueError(f'Only version 0 is currently supported, got version {version}')
+        if version not in SUPPORTED_VERSIONS:
+            raise ValueError(f'Only versions {SUPPORTED_VERSIONS} are currently supported, got version {version}')
         kind = get_value(data, 'kind', str, False)
         side = get_value(data, 'side', str, False)
-        match side:
-            case 'SERVER':
-                return ServerMessage.from_dict(data, id, kind)
-            case 'CLIENT':
-                return ClientMessage.from_dict(data, id, kind)
-            case _:
+        message_type = MESSAGE_TYPES.get((side, kind))
+        if message_type is None:
+            if side not in ('SERVER', 'CLIENT'):
                 raise ValueError(f'Invalid side `{side}`')
+            raise ValueError(f'Invalid kind `{kind}` for {side.capitalize()}Message')
+        if side == 'CLIENT':
+            message = message_type.from_dict(data, id, get_value(data, 'key', str, False))
+        else:
+            message = message_type.from_dict(data, id)
+        message.version = version
+        return message
 
 class ClientMessage(Message):
-    def __init__(self, id: str, kind: str, key: str):
-        super().__init__(id, kind, 'CLIENT')
+    __slots__ = ('key',)
+    side = 'CLIENT'
+
+    def __init__(self, id: str, key: str):
+        super().__init__(id)
         self.key = key
 
     def to_dict(self) -> dict:
-        return super().to_dict() | { 'key': self.key }
-    
-    def from_dict(data: dict, id: str, kind: str) -> 'Message':
-        key = get_value(data, 'key', str, False)
-        match kind:
-            case SessionRegisterMessage.kind:
-                return SessionRegisterMessage.from_dict(data, id, key)
-            case ClientOkMessage.kind:
-                return ClientOkMessage.from_dict(data, id, key)
-            case ErrorMessage.kind:
-                return ErrorMessage.from_dict(data, id, key)
-            case ResultMessage.kind:
-                return ResultMessage.from_dict(data, id, key)
-            case _:
-                raise ValueError(f'Invalid kind `{kind}` for ClientMessage')
-            
+        return { 'id': self.id, 'version': self.version, 'kind': self.kind, 'side': 'CLIENT', 'key': self.key }
+
 class ServerMessage(Message):
-    def __init__(self, id: str, kind: str):
-        super().__init__(id, kind, 'SERVER')
+    __slots__ = ()
+    side = 'SERVER'
 
     def to_dict(self) -> dict:
-        return super().to_dict()
-
-    def from_dict(data: dict, id: str, kind: str) -> 'Message':
-        match kind:
-            case ServerOkMessage.kind:
-                return ServerOkMessage.from_dict(data, id)
-            case InvalidMessage.kind:
-                return InvalidMessage.from_dict(data, id)
-            case EvaluateMessage.kind:
-                return EvaluateMessage.from_dict(data, id)
-            case TimeoutMessage.kind:
-                return TimeoutMessage.from_dict(data, id)
-            case _:
-                raise ValueError(f'Invalid kind `{kind}` for ServerMessage')
+        return { 'id': self.id, 'version': self.version, 'kind': self.kind, 'side': 'SERVER' }
 
 class SessionRegisterMessage(ClientMessage):
+    __slots__ = ('cache_ttl', 'max_concurrency', 'encodings', 'session')
     kind = 'REGISTER'
-    def __init__(self, id: str, key: str):
-        super().__init__(id, SessionRegisterMessage.kind, key)
+    def __init__(self, id: str, key: str, cache_ttl: int|None = None, max_concurrency: int|None = None, encodings: list[str]|None = None, session: str|None = None):
+        super().__init__(id, key)
+        self.cache_ttl = cache_ttl
+        self.max_concurrency = max_concurrency
+        self.encodings = encodings
+        self.session = session
 
     def to_dict(self):
-        return super().to_dict()
-    
+        data = super().to_dict()
+        if self.cache_ttl is not None:
+            data['cache_ttl'] = self.cache_ttl
+        if self.max_concurrency is not None:
+            data['max_concurrency'] = self.max_concurrency
+        if self.encodings is not None:
+            data['encodings'] = self.encodings
+        if self.session is not None:
+            data['session'] = self.session
+        return data
+
     def from_dict(data, id: str, key: str):
-        return SessionRegisterMessage(id, key)
+        return SessionRegisterMessage(id, key, get_value(data, 'cache_ttl', int, True), get_value(data, 'max_concurrency', int, True), get_list(data, 'encodings', str, True),
+                                      get_value(data, 'session', str, True))
 
 class ClientOkMessage(ClientMessage):
+    __slots__ = ()
     kind = 'CLIENTOK'
-    def __init__(self, id: str, key: str):
-        super().__init__(id, ClientOkMessage.kind, key)
 
-    def to_dict(self):
-        return super().to_dict()
-    
     def from_dict(data, id: str, key: str):
         return ClientOkMessage(id, key)
 
 class ServerOkMessage(ServerMessage):
+    __slots__ = ('encoding', 'session')
     kind = 'SERVEROK'
-    def __init__(self, id: str):
-        super().__init__(id, ServerOkMessage.kind)
+    def __init__(self, id: str, encoding: str|None = None, session: str|None = None):
+        super().__init__(id)
+        self.encoding = encoding
+        self.session = session
 
     def to_dict(self):
-        return super().to_dict()
-    
+        data = super().to_dict()
+        if self.encoding is not None:
+            data['encoding'] = self.encoding
+        if self.session is not None:
+            data['session'] = self.session
+        return data
+
     def from_dict(data, id):
-        return ServerOkMessage(id)
+        return ServerOkMessage(id, get_value(data, 'encoding', str, True), get_value(data, 'session', str, True))
 
 class InvalidMessage(ServerMessage):
+    __slots__ = ('error',)
     kind = 'INVALID'
     def __init__(self, id: str, error: str|None = None):
-        super().__init__(id, InvalidMessage.kind)
+        super().__init__(id)
         self.error = error
 
     def to_dict(self) -> dict:
-        return super().to_dict() | { 'error': self.error }
-    
+        return { 'id': self.id, 'version': self.version, 'kind': 'INVALID', 'side': 'SERVER', 'error': self.error }
+
     def from_dict(data: dict, id: str) -> 'Message':
         error = get_value(data, 'error', str, True)
         return InvalidMessage(id, error)
-        
+
 class ErrorMessage(ClientMessage):
+    __slots__ = ('error',)
     kind = 'Error'
     def __init__(self, id: str, key: str, error: str|None = None):
-        super().__init__(id, ErrorMessage.kind, key)
+        super().__init__(id, key)
         self.error = error
 
     def to_dict(self) -> dict:
-        return super().to_dict() | { 'key': self.key }
-    
+        data = super().to_dict()
+        if self.error is not None:
+            data['error'] = self.error
+        return data
+
     def from_dict(data: dict, id: str, key: str) -> 'Message':
         error = get_value(data, 'error', str, True)
         return ErrorMessage(id, key, error)
 
 class EvaluateMessage(ServerMessage):
+    __slots__ = ('code', 'files', 'chunked')
     kind = 'EVALUATE'
-    def __init__(self, id: str, code: str):
-        super().__init__(id, EvaluateMessage.kind)
+    def __init__(self, id: str, code: str, files: list[str]|None = None, chunked: bool = False):
+        super().__init__(id)
         self.code = code
+        self.files = files
+        self.chunked = chunked
 
     def to_dict(self) -> dict:
-        return super().to_dict() | { 'code': self.code }
-    
+        data = { 'id': self.id, 'version': self.version, 'kind': 'EVALUATE', 'side': 'SERVER', 'code': self.code }
+        if self.files is not None:
+            data['files'] = self.files
+        if self.chunked:
+            data['chunked'] = True
+        return data
+
     def from_dict(data: dict, id: str) -> 'Message':
         code = get_value(data, 'code', str, False)
-        return EvaluateMessage(id, code)
+        files = get_list(data, 'files', str, True)
+        chunked = get_value(data, 'chunked', bool, True)
+        return EvaluateMessage(id, code, files, chunked is True)
+
+class EvaluateChunkMessage(ServerMessage):
+    __slots__ = ('data', 'file')
+    kind = 'EVALUATE_CHUNK'
+    def __init__(self, id: str, data: str, file: str|None = None):
+        super().__init__(id)
+        self.data = data
+        self.file = file
+
+    def to_dict(self) -> dict:
+        data = { 'id': self.id, 'version': self.version, 'kind': 'EVALUATE_CHUNK', 'side': 'SERVER', 'data': self.data }
+        if self.file is not None:
+            data['file'] = self.file
+        return data
+
+    def from_dict(data: dict, id: str) -> 'Message':
+        return EvaluateChunkMessage(id, get_value(data, 'data', str, False), get_value(data, 'file', str, True))
 
 class TimeoutMessage(ServerMessage):
+    __slots__ = ()
     kind = 'TIMEOUT'
-    def __init__(self, id: str):
-        super().__init__(id, TimeoutMessage.kind)
 
-    def to_dict(self) -> dict:
-        return super().to_dict()
-    
     def from_dict(data: dict, id: str) -> 'Message':
         return TimeoutMessage(id)
 
 class ResultMessage(ClientMessage):
+    __slots__ = ('success', 'error', 'exit_code', 'stdout', 'stderr')
     kind = 'RESULT'
     def __init__(self, id: str, key: str, success: bool, error: str|None = None, exit_code: int|None = None, stdout: str|None = None, stderr: str|None = None):
-        super().__init__(id, ResultMessage.kind, key)
+        super().__init__(id, key)
         self.success = success
         self.error = error
         self.exit_code = exit_code
@@ -183,7 +271,11 @@ class ResultMessage(ClientMessage):
         self.stderr = stderr
 
     def to_dict(self) -> dict:
-        data = super().to_dict()
+        return self.fields({ 'id': self.id, 'version': self.version, 'kind': 'RESULT', 'side': 'CLIENT', 'key': self.key })
+
+    def fields(self, data: dict|None = None) -> dict:
+        if data is None:
+            data = {}
         if self.success:
             data['success'] = True
             if self.exit_code is not None:
@@ -202,4 +294,54 @@ class ResultMessage(ClientMessage):
         if get_value(data, 'success', bool, False):
             return ResultMessage(id, key, True, None, get_value(data, 'exit_code', int, True), get_value(data, 'stdout', str, True), get_value(data, 'stderr', str, True))
         else:
-            return ResultMessage(id, key, False, get_value(data, 'error', str, True), None, None, None)
\ No newline at end of file
+            return ResultMessage(id, key, False, get_value(data, 'error', str, True), None, None, None)
+
+class OutputChunkMessage(ClientMessage):
+    __slots__ = ('stream', 'data')
+    kind = 'OUTPUT_CHUNK'
+    def __init__(self, id: str, key: str, stream: str, data: str):
+        super().__init__(id, key)
+        self.stream = stream
+        self.data = data
+
+    def to_dict(self) -> dict:
+        return { 'id': self.id, 'version': self.version, 'kind': 'OUTPUT_CHUNK', 'side': 'CLIENT', 'key': self.key, 'stream': self.stream, 'data': self.data }
+
+    def from_dict(data: dict, id: str, key: str) -> 'Message':
+        stream = get_value(data, 'stream', str, False)
+        if stream != 'stdout' and stream != 'stderr':
+            raise ValueError(f'Invalid stream `{stream}`, expected stdout or stderr')
+        return OutputChunkMessage(id, key, stream, get_value(data, 'data', str, False))
+
+class EvaluateBatchMessage(ServerMessage):
+    __slots__ = ('codes',)
+    kind = 'EVALUATE_BATCH'
+    def __init__(self, id: str, codes: list[str]):
+        super().__init__(id)
+        self.codes = codes
+
+    def to_dict(self) -> dict:
+        return { 'id': self.id, 'version': self.version, 'kind': 'EVALUATE_BATCH', 'side': 'SERVER', 'codes': self.codes }
+
+    def from_dict(data: dict, id: str) -> 'Message':
+        return EvaluateBatchMessage(id, get_list(data, 'codes', str, False))
+
+class BatchResultMessage(ClientMessage):
+    __slots__ = ('results',)
+    kind = 'RESULT_BATCH'
+    def __init__(self, id: str, key: str, results: list[ResultMessage]):
+        super().__init__(id, key)
+        self.results = results
+
+    def to_dict(self) -> dict:
+        return { 'id': self.id, 'version': self.version, 'kind': 'RESULT_BATCH', 'side': 'CLIENT', 'key': self.key, 'results': [result.fields() for result in self.results] }
+
+    def from_dict(data: dict, id: str, key: str) -> 'Message':
+        results = get_list(data, 'results', dict, False)
+        return BatchResultMessage(id, key, [ResultMessage.from_dict(result, id, key) for result in results])
+
+# (side, kind) -> message class, replaces matching on side and then kind for every frame
+MESSAGE_TYPES: dict[tuple[str, str], type] = { (message_type.side, message_type.kind): message_type for message_type in (
+    SessionRegisterMessage, ClientOkMessage, ErrorMessage, ResultMessage, OutputChunkMessage, BatchResultMessage,
+    ServerOkMessage, InvalidMessage, EvaluateMessage, EvaluateChunkMessage, EvaluateBatchMessage, TimeoutMessage,
+) }
@@ -1,119 +1,473 @@
 from websockets.asyncio.server import serve, ServerConnection
-from websockets.exceptions import ConnectionClosedError
+from websockets.exceptions import ConnectionClosed, ConnectionClosedError
+from collections import deque
 import asyncio
-import json
+import time
 
 import config
+import metrics
 import protocol
 from store import Store
+from scheduler import FairQueue, RateLimiter
+from recorder import Recorder
+from gateway import ParsedMessage
+from sources import SourceFile
+
+class ClientDisconnected(Exception):
+    pass
+
+class ClientBusy(Exception):
+    pass
+
+class QueueTimeout(Exception):
+    pass
+
+class ClientUnhealthy(Exception):
+    pass
+
+class UnsupportedByClient(Exception):
+    def __init__(self, message: str):
+        super().__init__(message)
+        self.message = message
 
 class Client:
-    def __init__(self, key: str, socket: ServerConnection):
+    def __init__(self, key: str, socket: ServerConnection, cache_ttl: int = 0, max_concurrency: int = 1, version: int = 0, encoding: str = 'json', language: str = ''):
         self.key = key
+        # name of the language, used to label metrics
+        self.language = language
         self.socket = socket
-        self.lock = asyncio.Lock()
-        self.conversations: dict[str, asyncio.Queue] = {}
+        self.version = version
+        self.encoding = encoding
+        self.cache_ttl = cache_ttl
+        self.max_concurrency = max_concurrency
+        # only touched from the event loop, so routing needs no lock
+        self.conversations: dict[str, 'Conversation'] = {}
+        self.closed = False
+        # conversations handed out for this connection that have not finished yet
+        self.outstanding = 0
+        # moving average of the time between a conversation's first message and the answer
+        self.latency = 0.0
+        # round trip time of the last answered ping
+        self.rtt: float|None = None
+        self.timeouts = 0
+        self.failed_pings = 0
+        self.unhealthy_until = 0.0
+        # token to resume the session after a disconnect, None for clients before version 5
+        self.session: str|None = None
+        # encoded messages for the client sent while it was disconnected, flushed when it resumes
+        self.outbox: deque[str|bytes] = deque()
+        # drops the session once the grace period after a disconnect is over
+        self.expiry: asyncio.TimerHandle|None = None
+
+    def record_latency(self, latency: float):
+        self.latency += (latency - self.latency) * config.CLIENT_LATENCY_SMOOTHING
+
+    @property
+    def healthy(self) -> bool:
+        return self.failed_pings < config.UNHEALTHY_AFTER_FAILED_PINGS and time.monotonic() >= self.unhealthy_until
+
+    def record_timeout(self):
+        self.timeouts += 1
+        if self.timeouts >= config.UNHEALTHY_AFTER_TIMEOUTS:
+            self.unhealthy_until = time.monotonic() + config.UNHEALTHY_COOLDOWN_MS / 1000.0
+
+    def record_success(self):
+        self.timeouts = 0
+        self.unhealthy_until = 0.0
+
+class ClientPool:
+    # all connections that registered with the same key
+    def __init__(self, key: str):
+        self.key = key
+        self.connections: list[Client] = []
+        # requests waiting for a connection with spare capacity, served round robin per user
+        self.waiters = FairQueue()
+
+    @property
+    def cache_ttl(self) -> int:
+        return min(client.cache_ttl for client in self.connections)
+
+    @property
+    def version(self) -> int:
+        return min(client.version for client in self.connections)
+
+    @property
+    def healthy(self) -> bool:
+        return any(client.healthy for client in self.connections)
+
+    def least_loaded(self) -> Client|None:
+        available = [client for client in self.connections if client.outstanding < client.max_concurrency and client.healthy]
+        if len(available) == 0:
+            return None
+        return min(available, key=lambda client: (client.outstanding / client.max_concurrency, client.latency))
+
+    def is_full(self) -> bool:
+        return self.least_loaded() is None and len(self.waiters) >= config.MAX_QUEUED_EVALUATIONS
+
+    async def acquire(self, user: int = 0) -> Client:
+        if len(self.connections) == 0:
+            raise ClientDisconnected()
+        if not self.healthy:
+            raise ClientUnhealthy()
+        client = self.least_loaded()
+        if client is not None and len(self.waiters) == 0:
+            client.outstanding += 1
+            return client
+        if len(self.waiters) >= config.MAX_QUEUED_EVALUATIONS:
+            raise ClientBusy()
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.push(user, waiter)
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter), timeout=config.QUEUE_TIMEOUT_MS / 1000.0)
+        except BaseException as e:
+            if not waiter.done():
+                waiter.cancel()
+                self.waiters.remove(user, waiter)
+            elif not waiter.cancelled() and waiter.exception() is None:
+                # a connection was handed over just as the wait was given up
+                self.release(waiter.result())
+            if isinstance(e, asyncio.TimeoutError):
+                raise QueueTimeout()
+            raise
+
+    def release(self, client: Client):
+        client.outstanding -= 1
+        self.wake()
+
+    def wake(self):
+        # hands free capacity to the waiters in order
+        while len(self.waiters) > 0:
+            if len(self.connections) == 0 or not self.healthy:
+                error = ClientDisconnected if len(self.connections) == 0 else ClientUnhealthy
+                for waiter in self.waiters.clear():
+                    if not waiter.done():
+                        waiter.set_exception(error())
+                return
+            client = self.least_loaded()
+            if client is None:
+                return
+            waiter = self.waiters.pop()
+            if not waiter.done():
+                client.outstanding += 1
+                waiter.set_result(client)
 
 class Conversation:
-    def __init__(self, server: 'ClientHookServer', client: Client):
+    def __init__(self, server: 'ClientHookServer', pool: ClientPool, client: Client):
         self.server = server
+        self.pool = pool
         self.client = client
         self.id: str|None = None
-        self.queue: asyncio.Queue|None = None
+        # messages that arrived while nobody was waiting in receive, None marks a lost connection
+        self.inbox: deque[protocol.Message|None] = deque()
+        self.waiter: asyncio.Future|None = None
+        self.sent_at: float|None = None
 
     async def __aenter__(self) -> 'Conversation':
         self.id = protocol.new_id()
-        self.queue = asyncio.Queue()
-        async with self.client.lock:
-            self.client.conversations[self.id] = self.queue
+        self.client.conversations[self.id] = self
+        metrics.IN_FLIGHT.inc(self.client.language)
+        if self.client.closed:
+            self.inbox.append(None)
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
+        self.client.conversations.pop(self.id, None)
+        metrics.IN_FLIGHT.dec(self.client.language)
         self.id = None
-        self.queue = None
-        async with self.client.lock:
-            if self.id in self.client.conversations:
-                del self.client.conversations[self.id]
+        self.inbox.clear()
+        self.pool.release(self.client)
+
+    def deliver(self, message: protocol.Message|None):
+        waiter = self.waiter
+        if waiter is not None and not waiter.done():
+            self.waiter = None
+            waiter.set_result(message)
+        else:
+            self.inbox.append(message)
 
     async def send(self, message: protocol.Message):
         assert self.id is not None, 'Must call Conversation.send inside with block'
-        data = message.to_dict()
-        raw = json.dumps(data)
-        await self.client.socket.send(raw)
+        message.version = self.client.version
+        raw = protocol.encode(message, self.client.encoding)
+        metrics.MESSAGES_SENT.inc(self.client.language, message.kind)
+        metrics.BYTES_SENT.inc(self.client.language, amount=len(raw))
+        if self.server.recorder is not None:
+            self.server.recorder.record('out', self.client.language, message, raw)
+        if self.sent_at is None:
+            self.sent_at = time.monotonic()
+        while not self.client.closed:
+            socket = self.client.socket
+            if socket is None:
+                # the client is away, this goes out once it resumes its session
+                self.client.outbox.append(raw)
+                return
+            try:
+                await socket.send(raw)
+                return
+            except ConnectionClosed:
+                if self.client.session is None:
+                    raise ClientDisconnected()
+                if self.client.socket is socket:
+                    self.client.outbox.append(raw)
+                    return
+        raise ClientDisconnected()
+
+    async def send_evaluation(self, code: str, files: list[SourceFile]):
+        # large inputs and attached files are split into EVALUATE_CHUNKs so no single frame grows unbounded
+        if self.client.version < 2:
+            if len(files) > 0:
+                raise UnsupportedByClient('The client does not support attached files (protocol version 2)')
+            await self.send(protocol.EvaluateMessage(self.id, code))
+            return
+        size = config.EVAL_CHUNK_CHARS
+        chunked = len(code) > size
+        if chunked:
+            for offset in range(0, len(code), size):
+                await self.send(protocol.EvaluateChunkMessage(self.id, code[offset:offset + size]))
+        for file in files:
+            for offset in range(0, max(len(file.content), 1), size):
+                await self.send(protocol.EvaluateChunkMessage(self.id, file.content[offset:offset + size], file.name))
+        await self.send(protocol.EvaluateMessage(self.id, '' if chunked else code, [file.name for file in files] if len(files) > 0 else None, chunked))
 
     async def receive(self) -> protocol.Message:
-        return await self.queue.get()
+        if len(self.inbox) > 0:
+            message = self.inbox.popleft()
+        else:
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                message = await self.waiter
+            finally:
+                self.waiter = None
+        if message is None:
+            # the connection went away while this conversation was still open
+            raise ClientDisconnected()
+        # only the answer that ends the conversation counts, output chunks would skew the average towards 0
+        if self.sent_at is not None and message.kind != protocol.OutputChunkMessage.kind:
+            self.client.record_latency(time.monotonic() - self.sent_at)
+        return message
 
 class ClientHookServer:
     def __init__(self, store: Store):
         self.address = config.WS_HOST
         self.port = config.WS_PORT
         self.store = store
-        self.clients_lock = asyncio.Lock()
-        self.clients: dict[str, Client] = {}
+        self.clients: dict[str, ClientPool] = {}
+        # session token -> client, connected or waiting to be resumed
+        self.sessions: dict[str, Client] = {}
+        self.register_limiter = RateLimiter(config.REGISTER_RATE_PER_MINUTE / 60.0, config.REGISTER_RATE_BURST, config.REGISTER_RATE_MAX_TRACKED_ADDRESSES)
+        self.recorder = Recorder(config.TRACE_PATH, config.TRACE_ROTATE_BYTES, config.TRACE_PAYLOADS, config.TRACE_MAX_QUEUED) if config.TRACE_PATH is not None else None
+        # set once clients can connect
+        self.listening = asyncio.Event()
 
     async def run(self):
         print(f'ClientHookServer started')
-        async with serve(self.handle_client, self.address, self.port) as server:
+        compression = None if config.WS_COMPRESSION == 'none' else config.WS_COMPRESSION
+        async with serve(self.handle_client, self.address, self.port, max_size=config.WS_MAX_FRAME_BYTES, compression=compression) as server:
+            self.listening.set()
             await server.serve_forever()
         print(f'ClientHookServer stopped')
 
     async def handle_client(self, socket: ServerConnection):
         print(f'{socket.remote_address} connected')
         client: Client = None
+        monitor: asyncio.Task|None = None
+        # replies use the protocol version and encoding the client last spoke
+        version = 0
+        encoding = 'json'
         try:
             async for raw_message in socket:
+                language = '' if client is None else client.language
+                metrics.BYTES_RECEIVED.inc(language, amount=len(raw_message))
                 try:
-                    data = json.loads(raw_message)
-                    message: protocol.ClientMessage = protocol.Message.from_dict(data)
+                    # gateway workers parse messages before they get here
+                    message: protocol.ClientMessage = raw_message.message() if isinstance(raw_message, ParsedMessage) else protocol.decode(raw_message)
+                    metrics.MESSAGES_RECEIVED.inc(language, message.kind)
+                    if self.recorder is not None:
+                        self.recorder.record('in', language, message, raw_message)
+                    version = message.version
                     if message.side != 'CLIENT':
-                        await socket.send(json.dumps(protocol.InvalidMessage(message.id, f'Expected CLIENT side message, got {message.side}').to_dict()))
+                        await self.reply(socket, protocol.InvalidMessage(message.id, f'Expected CLIENT side message, got {message.side}'), version, encoding)
                         continue
-                except json.JSONDecodeError as e:
-                    await socket.send(json.dumps(protocol.InvalidMessage('', str(e)).to_dict()))
                 except ValueError as e:
-                    await socket.send(json.dumps(protocol.InvalidMessage('', str(e)).to_dict()))
+                    # json.JSONDecodeError is a ValueError as well
+                    await self.reply(socket, protocol.InvalidMessage('', str(e)), version, encoding)
                     continue
                 if message.kind == protocol.SessionRegisterMessage.kind:
                     if client is not None:
-                        await socket.send(json.dumps(protocol.InvalidMessage(message.id, 'Already registered').to_dict()))
+                        await self.reply(socket, protocol.InvalidMessage(message.id, 'Already registered'), version, encoding)
                         continue
-                    if not await self.store.validate_key(message.key):
-                        await socket.send(json.dumps(protocol.InvalidMessage(message.id, 'Invalid key. Request a new one with `/client_key`').to_dict()))
+                    registered = await self.register(socket, message)
+                    if registered is None:
                         continue
-                    async with self.clients_lock:
-                        if message.key in self.clients:
-                            await socket.send(json.dumps(protocol.InvalidMessage(message.id, 'Client already logged in. Request a new key with `/client_key` to invalidate that session').to_dict()))
-                            continue
-                        client = Client(message.key, socket)
-                        self.clients[client.key] = client
-                    await socket.send(json.dumps(protocol.ServerOkMessage(message.id).to_dict()))
-                    print(f'{socket.remote_address} registered')
+                    pool, client = registered
+                    encoding = client.encoding
+                    monitor = asyncio.create_task(self.monitor(client))
                 elif client is not None:
-                    async with client.lock:
-                        if message.id in client.conversations:
-                            await client.conversations[message.id].put(message)
-                        else:
-                            await socket.send(json.dumps(protocol.InvalidMessage(message.id, 'No active conversation with that id').to_dict()))
+                    conversation = client.conversations.get(message.id)
+                    if conversation is not None:
+                        conversation.deliver(message)
+                    else:
+                        await self.reply(socket, protocol.InvalidMessage(message.id, 'No active conversation with that id'), version, encoding)
                 else:
-                    await socket.send(json.dumps(protocol.InvalidMessage(message.id, 'Client needs to be registered first').to_dict()))
+                    await self.reply(socket, protocol.InvalidMessage(message.id, 'Client needs to be registered first'), version, encoding)
         except ConnectionClosedError:
             print(f'{socket.remote_address} aborted connection')
         else:
             print(f'{socket.remote_address} disconnected')
         finally:
-            if client is not None:
-                async with self.clients_lock:
-                    del self.clients[client.key]
-
-    async def conversation(self, key: str) -> Conversation|None:
-        async with self.clients_lock:
-            if key in self.clients:
-                return Conversation(self, self.clients[key])
+            if monitor is not None:
+                monitor.cancel()
+            # a resumed session has moved on to another socket already
+            if client is not None and client.socket is socket:
+                self.detach(pool, client)
+
+    async def register(self, socket: ServerConnection, message: protocol.SessionRegisterMessage) -> tuple[ClientPool, Client]|None:
+        version = message.version
+        address = socket.remote_address[0] if socket.remote_address else ''
+        session = self.sessions.get(message.session) if message.session is not None else None
+        if session is not None and session.key != message.key:
+            session = None
+        # revoking a key drops its sessions and pools, so a live session or pool vouches for the key without asking the store
+        pool = self.clients.get(message.key)
+        if session is not None:
+            language = session.language
+        elif pool is not None and len(pool.connections) > 0:
+            language = pool.connections[0].language
+        else:
+            lang = self.store.find_by_key(message.key)
+            if lang is None:
+                # only failed attempts are charged, a client looping on a bad key must not lock out the valid ones behind the same address
+                wait = self.register_limiter.acquire(address)
+                if wait > 0:
+                    await self.reply(socket, protocol.InvalidMessage(message.id, f'Too many registrations, retry in {wait:.0f}s'), version)
+                    return None
+                await self.reply(socket, protocol.InvalidMessage(message.id, 'Invalid key. Request a new one with `/client_key`'), version)
+                return None
+            language = lang.name
+        # nothing between looking up the pool and joining it awaits, so no lock is needed
+        if pool is not None and session not in pool.connections and len(pool.connections) >= config.MAX_CLIENT_CONNECTIONS:
+            await self.reply(socket, protocol.InvalidMessage(message.id, f'Client already has {config.MAX_CLIENT_CONNECTIONS} connections. Request a new key with `/client_key` to invalidate those sessions'), version)
             return None
-        
+        if pool is None:
+            pool = ClientPool(message.key)
+            self.clients[message.key] = pool
+        cache_ttl = config.EVAL_CACHE_TTL_MS if message.cache_ttl is None else max(0, min(message.cache_ttl, config.EVAL_CACHE_TTL_MS))
+        max_concurrency = config.DEFAULT_CLIENT_CONCURRENCY if message.max_concurrency is None else max(1, min(message.max_concurrency, config.MAX_CLIENT_CONCURRENCY))
+        # the first encoding of the client's preference list the server supports, json stays the default
+        negotiated = next((name for name in message.encodings or () if name in protocol.ENCODINGS), None)
+        # until the outbox has been flushed sends are queued behind it, that keeps every conversation's messages in order
+        if session is None:
+            client = Client(message.key, None, cache_ttl, max_concurrency, version, negotiated or 'json', language)
+            if version >= 5:
+                client.session = protocol.new_key()
+                self.sessions[client.session] = client
+        else:
+            client = session
+            if client.expiry is not None:
+                client.expiry.cancel()
+                client.expiry = None
+            previous = client.socket
+            client.socket = None
+            if previous is not None:
+                # the client noticed the disconnect before the server did
+                asyncio.create_task(previous.close())
+            client.cache_ttl, client.max_concurrency, client.version, client.encoding = cache_ttl, max_concurrency, version, negotiated or 'json'
+        if client not in pool.connections:
+            pool.connections.append(client)
+            metrics.CONNECTIONS.inc(client.language)
+        pool.wake()
+        try:
+            # the ok still goes out as json, the client switches once it knows the encoding
+            await self.reply(socket, protocol.ServerOkMessage(message.id, negotiated, client.session), version)
+            while len(client.outbox) > 0:
+                await socket.send(client.outbox[0])
+                client.outbox.popleft()
+        except ConnectionClosed:
+            # the handler detaches the client again, the outbox is kept for the next attempt
+            pass
+        client.socket = socket
+        print(f'{socket.remote_address} {"resumed" if session is not None else "registered"} ({len(pool.connections)} connections)')
+        return pool, client
+
+    async def reply(self, socket: ServerConnection, message: protocol.ServerMessage, version: int, encoding: str = 'json'):
+        message.version = version
+        raw = protocol.encode(message, encoding)
+        if self.recorder is not None:
+            self.recorder.record('out', '', message, raw)
+        await socket.send(raw)
+
+    async def monitor(self, client: Client):
+        # pings the connection regularly, missing pongs make it unhealthy before a request has to time out
+        while True:
+            await asyncio.sleep(config.HEALTH_PING_INTERVAL_MS / 1000.0)
+            # a detached session has no socket, a resumed one may get a new socket while a ping is out
+            socket = client.socket
+            if socket is None:
+                continue
+            try:
+                pong = await socket.ping()
+                client.rtt = await asyncio.wait_for(pong, config.HEALTH_PING_TIMEOUT_MS / 1000.0)
+                client.failed_pings = 0
+                metrics.PING_SECONDS.observe(client.rtt, client.language)
+            except asyncio.TimeoutError:
+                client.failed_pings += 1
+                print(f'{socket.remote_address} ({client.language}) did not answer ping ({client.failed_pings} in a row)')
+            except ConnectionClosed:
+                return
+
+    def detach(self, pool: ClientPool, client: Client):
+        client.socket = None
+        if client in pool.connections:
+            pool.connections.remove(client)
+            metrics.CONNECTIONS.dec(client.language)
+            if len(pool.connections) == 0 and self.clients.get(client.key) is pool:
+                del self.clients[client.key]
+            pool.wake()
+        if client.session is None or client.closed or config.SESSION_GRACE_MS <= 0:
+            self.drop_session(client)
+        else:
+            # open conversations wait for the client to resume instead of failing right away
+            client.expiry = asyncio.get_running_loop().call_later(config.SESSION_GRACE_MS / 1000.0, self.drop_session, client)
+
+    def drop_session(self, client: Client):
+        if client.expiry is not None:
+            client.expiry.cancel()
+            client.expiry = None
+        if self.sessions.get(client.session) is client:
+            del self.sessions[client.session]
+        client.outbox.clear()
+        if client.closed:
+            return
+        client.closed = True
+        # fail open conversations over instead of letting them run into the timeout
+        for conversation in list(client.conversations.values()):
+            conversation.deliver(None)
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def pool(self, key: str) -> ClientPool|None:
+        pool = self.clients.get(key)
+        if pool is None or len(pool.connections) == 0:
+            return None
+        return pool
+
+    async def conversation(self, key: str, user: int = 0) -> Conversation|None:
+        # waits for a free slot if every connection is at its concurrency limit, raises ClientBusy if the queue is full
+        pool = self.pool(key)
+        if pool is None:
+            return None
+        try:
+            client = await pool.acquire(user)
+        except ClientDisconnected:
+            return None
+        return Conversation(self, pool, client)
+
     async def kill_client_conn(self, key: str):
-        async with self.clients_lock:
-            if key in self.clients:
-                await self.clients[key].socket.close()
-                self.clients[key].socket.abort_pings()
+        # revokes every connection of the pool
+        pool = self.clients.pop(key, None)
+        for client in [client for client in self.sessions.values() if client.key == key]:
+            self.drop_session(client)
+        if pool is not None:
+            await asyncio.gather(*(client.socket.close() for client in list(pool.connections) if client.socket is not None))
@@ -1,5 +1,4 @@
 import os
-import discord
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -12,14 +11,114 @@ TEST_GUILDS = [guild_id.strip() for guild_id in os.getenv('TEST_GUILDS', '').spl
 
 WS_HOST = 'localhost'
 WS_PORT = 1717
+# largest websocket frame accepted from a client
+WS_MAX_FRAME_BYTES = 1024 * 1024
+# permessage-deflate for client connections, 'deflate' or 'none'
+WS_COMPRESSION = 'deflate'
+# worker processes that accept client websockets on WS_PORT with SO_REUSEPORT and forward them to the bot, 0 serves them from the bot process
+GATEWAY_WORKERS = 0
+# unix socket the gateway workers connect to
+GATEWAY_SOCKET = 'data/gateway.sock'
+# messages a gateway worker holds for a client that reads slower than the bot sends, it closes the connection when more arrive
+GATEWAY_MAX_QUEUED_MESSAGES = 256
+# prometheus metrics are served on http://METRICS_HOST:METRICS_PORT/metrics, None disables the endpoint
+METRICS_HOST = 'localhost'
+METRICS_PORT: int|None = 9171
+# client traffic is recorded to TRACE_PATH-<timestamp>-<part>.jsonl.gz for bench/replay.py, None disables recording
+TRACE_PATH: str|None = None
+# a new trace file is started after this many uncompressed bytes
+TRACE_ROTATE_BYTES = 64 * 1024 * 1024
+# also record message contents except client keys, otherwise only direction, conversation id, kind, size and time are kept
+TRACE_PAYLOADS = False
+# frames waiting for the trace writer, more are dropped while it falls behind
+TRACE_MAX_QUEUED = 10000
+# inputs longer than this are sent to clients in EVALUATE_CHUNK pieces of this size
+EVAL_CHUNK_CHARS = 64 * 1024
+# attachments of a message passed to `run`, larger ones are ignored
+MAX_ATTACHMENT_BYTES = 1024 * 1024
+MAX_ATTACHMENTS = 10
 
+# connections a single client key may hold, evaluations go to the least loaded one
+MAX_CLIENT_CONNECTIONS = 8
+# evaluations a single connection runs at once, clients may advertise their own limit when registering
+DEFAULT_CLIENT_CONCURRENCY = 1
+MAX_CLIENT_CONCURRENCY = 64
+# evaluations waiting for a free connection, requests beyond this are rejected as busy
+MAX_QUEUED_EVALUATIONS = 16
+# how long a request may wait for a free connection, separate from EVAL_TIMEOUT_MS
+QUEUE_TIMEOUT_MS: int = 10000
+# per discord user token bucket for evaluations, comparing languages or running several blocks takes one token each
+EVAL_RATE_PER_MINUTE = 20
+EVAL_RATE_BURST = 5
+# idle buckets are dropped once they are full again, this caps how many are kept at once
+EVAL_RATE_MAX_TRACKED_USERS = 10000
+# weight of the newest sample in the per connection latency average
+CLIENT_LATENCY_SMOOTHING = 0.2
+# every connection is pinged this often, a missing pong counts as a failed ping
+HEALTH_PING_INTERVAL_MS: int = 5000
+HEALTH_PING_TIMEOUT_MS: int = 2000
+# a connection with this many timeouts in a row or failed pings is unhealthy and new requests fail right away
+UNHEALTHY_AFTER_TIMEOUTS = 3
+UNHEALTHY_AFTER_FAILED_PINGS = 2
+# after timing out a connection gets another request once this has passed, a success makes it healthy again
+UNHEALTHY_COOLDOWN_MS: int = 30000
+# a disconnected client (version >= 5) may resume its session this long after, its open conversations wait for it meanwhile
+SESSION_GRACE_MS: int = 15000
+# per remote address token bucket for REGISTER with an unknown key. valid keys and resumes are never throttled,
+# all clients may share one address behind a local proxy and must all be back soon after a restart
+REGISTER_RATE_PER_MINUTE = 60
+REGISTER_RATE_BURST = 20
+REGISTER_RATE_MAX_TRACKED_ADDRESSES = 10000
+
+# 'sqlite' or 'shelve'
+STORE_BACKEND = 'sqlite'
+CLIENTS_DB = 'data/clients.sqlite3'
+# legacy shelve store, migrated into CLIENTS_DB on first start of the sqlite backend
 CLIENTS_STORE = 'data/clients.shelve'
 
-DISCORD_OK_COLOR = discord.Color(0x0099FF)
-DISCORD_ERR_COLOR = discord.Color.red()
+# embed colors, plain ints so importing config does not import discord
+DISCORD_OK_COLOR: int = 0x0099FF
+DISCORD_ERR_COLOR: int = 0xE74C3C
 
+# results arriving within this are sent as the first response, slower ones defer first. Keep it well below discord's 3s interaction window
+FAST_RESPONSE_MS: int = 1500
+# used for languages whose owner did not set a timeout with /client_timeout
 EVAL_TIMEOUT_MS: int = 5000
+# bounds of the timeout a language owner may set
+MIN_EVAL_TIMEOUT_MS: int = 500
+MAX_EVAL_TIMEOUT_MS: int = 30000
+
+# clients may lower the ttl or opt out with cache_ttl = 0 when registering
+EVAL_CACHE_TTL_MS: int = 10 * 60 * 1000
+EVAL_CACHE_MAX_ENTRIES = 1024
+EVAL_CACHE_MAX_BYTES = 16 * 1024 * 1024
+EVAL_CACHE_MAX_ENTRY_BYTES = 256 * 1024
 ERROR_MSG_DELETE_AFTER_MS: int|None = 30000
 
+# output streamed by a client is kept in memory up to OUTPUT_SPOOL_BYTES per stream, then spilled to a temporary file
+OUTPUT_SPOOL_BYTES = 64 * 1024
+# total stdout and stderr kept per evaluation, anything beyond is dropped
+MAX_OUTPUT_BYTES = 8 * 1024 * 1024
+# attachments of results larger than this are sent gzip compressed
+ATTACHMENT_COMPRESS_BYTES = 1024 * 1024
+# memory a compressed attachment may take while it is built, anything beyond goes to a temporary file
+RENDER_SPOOL_BYTES = 1024 * 1024
+# minimum time between two edits of a response while output is streamed
+STREAM_EDIT_INTERVAL_MS: int = 1000
+# comparing languages in one /eval: how many at most, the shared deadline for all of them and the width of an output preview
+MAX_FANOUT_LANGUAGES: int = 10
+FANOUT_DEADLINE_MS: int = 10000
+FANOUT_PREVIEW_CHARS: int = 40
+# watched messages run again this long after their last edit, and are watched for this long. Interaction responses can only be edited for 15 minutes
+WATCH_DEBOUNCE_MS: int = 1500
+WATCH_DURATION_MS: int = 10 * 60 * 1000
+
+# code blocks of a single message that `run` evaluates at once, one embed each
+MAX_BATCH_BLOCKS = 10
+
 MAX_EMBED_DESCRIPTION_SIZE = 4096
-MAX_EMBED_FIELD_SIZE = 1024
\ No newline at end of file
+MAX_EMBED_FIELD_SIZE = 1024
+# combined size of all embeds in one message
+MAX_MESSAGE_EMBEDS_SIZE = 6000
+# name and value of an autocomplete choice
+MAX_CHOICE_SIZE = 100
\ No newline at end of file
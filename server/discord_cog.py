@@ -5,14 +5,29 @@ import discord.ext.tasks
 from discord.ext import commands
 from discord.commands.context import ApplicationContext
 from discord.commands import Option
-import io
 
+from typing import Awaitable
+import importlib
+import hashlib
+import time
+import sys
 import re
 
-from client_hook import ClientHookServer
+from client_hook import ClientHookServer, Conversation, ClientDisconnected, ClientBusy, ClientUnhealthy, QueueTimeout, UnsupportedByClient
+from eval_cache import EvalCache
+from scheduler import Scheduler
+from output import Output
+from sources import SourceFile, CodeBlock, parse_code_blocks, lang_override
 from store import Store, Language, LanguageRegistrationException
 import config
+import metrics
 import protocol
+import renderer
+
+# modules without state of their own, /reload re-executes them along with this one
+RELOADED_MODULES = ('config', 'sources', 'renderer')
+
+EVALUATION_FAILURES = (asyncio.TimeoutError, ClientDisconnected, ClientBusy, ClientUnhealthy, QueueTimeout, UnsupportedByClient)
 
 class Permissions:
     RUN_CLIENT = 0
@@ -24,20 +39,91 @@ def is_identifier(ident: str) -> bool:
         return False
     return ident_pattern.match(ident) is not None
 
-def text_to_memfile(text: str) -> io.BytesIO:
-    file = io.BytesIO()
-    file.write(text.encode())
-    file.seek(0)
-    return file
+def timeout_ms(language: Language) -> int:
+    # the owner's budget, kept within the current global bounds
+    if language.timeout_ms is None:
+        return config.EVAL_TIMEOUT_MS
+    return max(config.MIN_EVAL_TIMEOUT_MS, min(language.timeout_ms, config.MAX_EVAL_TIMEOUT_MS))
+
+def split_languages(value: str) -> list[str]:
+    return [name for name in re.split(r'[,\s]+', value) if len(name) > 0]
+
+def outcome_label(title: str) -> str:
+    # metrics label of a response, derived from its embed title
+    if title.startswith('Evaluation'):
+        return 'success'
+    return title.lower().replace(' ', '_')
+
+def readable_attachments(message: discord.Message) -> list[discord.Attachment]:
+    # attachments that are read as source files, media and oversized files are ignored
+    return [attachment for attachment in message.attachments[:config.MAX_ATTACHMENTS] if attachment.size <= config.MAX_ATTACHMENT_BYTES
+            and (attachment.content_type is None or attachment.content_type.split('/')[0] not in ('image', 'video', 'audio'))]
+
+def message_digest(message: discord.Message) -> bytes:
+    # what a run of the message depends on, an edit of the prose around the code leaves it unchanged
+    digest = hashlib.sha256()
+    for block in parse_code_blocks(message.system_content):
+        for part in (block.lang or '', block.code):
+            digest.update(f'{len(part)}:{part}'.encode())
+    override = lang_override(message.system_content)
+    digest.update(f'\0{override}'.encode())
+    for attachment in readable_attachments(message):
+        digest.update(f'\0{attachment.id}'.encode())
+    return digest.digest()
+
+def log_failed_run(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f'Watched run failed: {task.exception()!r}')
+
+class Watch:
+    # a message whose code runs again after every edit, until WATCH_DURATION_MS after the run command
+    def __init__(self, ctx: 'WatchContext', ephemeral: bool, digest: bytes):
+        self.ctx = ctx
+        self.ephemeral = ephemeral
+        self.digest = digest
+        self.task: asyncio.Task|None = None
+        self.pending: asyncio.TimerHandle|None = None
+        self.expiry: asyncio.TimerHandle|None = None
+
+class WatchContext:
+    # the interaction of a watched message, the first run responds to it and every later run edits that response
+    def __init__(self, ctx: ApplicationContext):
+        self.ctx = ctx
+        self.author = ctx.author
+
+    async def defer(self, **kwargs):
+        if not self.ctx.response.is_done():
+            await self.ctx.defer(**kwargs)
+
+    async def respond(self, **kwargs):
+        # the response is edited by the next run, it must not delete itself
+        kwargs.pop('delete_after', None)
+        if not self.ctx.response.is_done():
+            await self.ctx.respond(**kwargs)
+        else:
+            await self.edit(**kwargs)
+
+    async def edit(self, **kwargs):
+        kwargs.pop('ephemeral', None)
+        kwargs.pop('delete_after', None)
+        # files of the previous run are replaced
+        await self.ctx.edit(attachments=[], **kwargs)
 
 class LanguageCog(commands.Cog): # command_attrs=dict(guild_ids=config.TEST_GUILDS)
-    def __init__(self, bot: discord.Bot, server: ClientHookServer, store: Store):
+    def __init__(self, bot: discord.Bot, server: ClientHookServer, store: Store, cache: EvalCache|None = None):
         self.bot = bot
         self.server = server
         self.store = store
+        self.cache = EvalCache() if cache is None else cache
+        self.scheduler = Scheduler(server)
+        self.watches: dict[int, Watch] = {}
         print(f'Initialized LanguageCog')
 
     def cog_unload(self):
+        # runs already started finish, edits after a reload are no longer watched
+        for watch in self.watches.values():
+            self.cancel_timers(watch)
+        self.watches.clear()
         print(f'Unloaded LanguageCog')
 
     @discord.slash_command(description='Sends a new client key as an ephemeral message.')
@@ -59,7 +145,8 @@ class LanguageCog(commands.Cog): # command_attrs=dict(guild_ids=config.TEST_GUIL
             await self.send_error_message(ctx, 'Invalid argument', 'Your language\'s short form name must be an identifier `[_a-zA-Z][_a-zA-Z0-9]*` between 3 and 16 characters long')
             return
         key = protocol.new_key()
-        language = Language(ctx.author.id, name, short, key)
+        old_lang = self.store.find_by_user(ctx.author.id)
+        language = Language(ctx.author.id, name, short, key, None if old_lang is None else old_lang.timeout_ms)
         try:
             old_lang = await self.store.register_lang(language)
         except LanguageRegistrationException as e:
@@ -67,110 +154,567 @@ class LanguageCog(commands.Cog): # command_attrs=dict(guild_ids=config.TEST_GUIL
             return
         if old_lang is not None:
             await self.server.kill_client_conn(old_lang.key) # kill the current one
+            self.cache.invalidate(old_lang.key)
         embed = discord.Embed(color=config.DISCORD_OK_COLOR, title='Client token', description=f'This is your new client key:\n`{key}`\nDo not share this key with anyone! Any old keys are now disabled.')
         await ctx.respond(embed=embed, ephemeral=True)
 
+    @discord.slash_command(description='Sets how long your language\'s client may take per evaluation')
+    async def client_timeout(self, ctx: ApplicationContext,
+                             milliseconds: Option(int, 'The timeout in milliseconds, leave out to use the default', required=False)): # type: ignore
+        if milliseconds is not None and not config.MIN_EVAL_TIMEOUT_MS <= milliseconds <= config.MAX_EVAL_TIMEOUT_MS:
+            await self.send_error_message(ctx, 'Invalid argument', f'The timeout must be between {config.MIN_EVAL_TIMEOUT_MS} and {config.MAX_EVAL_TIMEOUT_MS} milliseconds')
+            return
+        language = await self.store.set_timeout(ctx.author.id, milliseconds)
+        if language is None:
+            await self.send_error_message(ctx, 'No language', 'You have not registered a language, request a key with `/client_key` first')
+            return
+        embed = discord.Embed(color=config.DISCORD_OK_COLOR, title='Client timeout', description=f'{language.name} evaluations now time out after {timeout_ms(language) / 1000.0}s')
+        await ctx.respond(embed=embed, ephemeral=True)
+
+    @discord.slash_command(description='Shows evaluation cache statistics')
+    async def cache_stats(self, ctx: ApplicationContext):
+        embed = discord.Embed(color=config.DISCORD_OK_COLOR, title='Evaluation cache')
+        embed.add_field(name='hits', value=str(self.cache.hits))
+        embed.add_field(name='misses', value=str(self.cache.misses))
+        embed.add_field(name='coalesced', value=str(self.cache.coalesced))
+        embed.add_field(name='entries', value=str(len(self.cache.entries)))
+        embed.add_field(name='size', value=f'{self.cache.size} bytes')
+        await ctx.respond(embed=embed, ephemeral=True)
+
+    @discord.slash_command(name='metrics', description='Shows evaluation metrics per language (bot owner only)')
+    async def show_metrics(self, ctx: ApplicationContext):
+        if not await self.bot.is_owner(ctx.author):
+            await self.send_error_message(ctx, 'Invalid permission', 'Only the bot owner can view metrics')
+            return
+        languages = sorted({labels[0] for labels in metrics.EVALUATIONS.values} | {labels[0] for labels in metrics.CONNECTIONS.values} - {''})
+        embed = discord.Embed(color=config.DISCORD_OK_COLOR, title='Metrics')
+        def milliseconds(histogram: metrics.Histogram, q: float, name: str) -> str:
+            value = histogram.quantile(q, name)
+            return '-' if value is None else f'{value * 1000:.0f}ms'
+        for name in languages[:25]:
+            evaluations = sum(value for labels, value in metrics.EVALUATIONS.values.items() if labels[0] == name)
+            embed.add_field(name=name, value='\n'.join((
+                f'evaluations: {evaluations} ({metrics.EVALUATIONS.get(name, "success")} successful)',
+                f'latency p50/p95: {milliseconds(metrics.EVALUATION_SECONDS, 0.5, name)} / {milliseconds(metrics.EVALUATION_SECONDS, 0.95, name)}',
+                f'p95 queue/client/respond: {milliseconds(metrics.QUEUE_SECONDS, 0.95, name)} / {milliseconds(metrics.CLIENT_SECONDS, 0.95, name)} / {milliseconds(metrics.RESPOND_SECONDS, 0.95, name)}',
+                f'in flight: {metrics.IN_FLIGHT.get(name)}, connections: {metrics.CONNECTIONS.get(name)}',
+                f'timeouts: {metrics.TIMEOUTS.get(name)}, client errors: {metrics.CLIENT_ERRORS.get(name)}',
+                f'received/sent: {metrics.BYTES_RECEIVED.get(name)} / {metrics.BYTES_SENT.get(name)} bytes',
+            )))
+        if len(languages) == 0:
+            embed.description = 'No evaluations yet'
+        elif config.METRICS_PORT is not None:
+            embed.set_footer(text=f'All metrics at http://{config.METRICS_HOST}:{config.METRICS_PORT}/metrics')
+        await ctx.respond(embed=embed, ephemeral=True)
+
+    async def language_autocomplete(self, ctx: discord.AutocompleteContext) -> list[discord.OptionChoice]:
+        # only reads in-memory indexes, languages whose client is connected come first
+        value = ctx.value or ''
+        # in a list of languages only the last one is completed
+        separator = max(value.rfind(','), value.rfind(' ')) + 1
+        head, listed = value[:separator], set(split_languages(value[:separator]))
+        languages = [language for language in self.store.complete(value[separator:]) if language.name not in listed and language.short not in listed]
+        online = { language.name for language in languages if self.server.pool(language.key) is not None }
+        languages.sort(key=lambda language: language.name not in online)
+        # the name only shows the completed language, discord rejects the whole response if a value is too long
+        return [discord.OptionChoice(f'{language.name} ({language.short}{"" if language.name in online else ", offline"})'[:config.MAX_CHOICE_SIZE], f'{head}{language.name}')
+                for language in languages if len(head) + len(language.name) <= config.MAX_CHOICE_SIZE][:25]
+
+    @discord.slash_command(name='reload', description='Reloads config and bot commands without dropping client connections (bot owner only)')
+    async def reload(self, ctx: ApplicationContext):
+        if not await self.bot.is_owner(ctx.author):
+            await self.send_error_message(ctx, 'Invalid permission', 'Only the bot owner can reload the bot')
+            return
+        # evaluations already running finish on this instance, the websocket server and store are shared
+        try:
+            for name in RELOADED_MODULES:
+                importlib.reload(sys.modules[name])
+            self.bot.reload_extension(__name__)
+        except Exception as e:
+            await self.send_error_message(ctx, 'Reload failed', f'```\n{e}```')
+            return
+        await self.bot.sync_commands()
+        await ctx.respond(embed=discord.Embed(color=config.DISCORD_OK_COLOR, title='Reloaded', description=f'Reloaded {", ".join(RELOADED_MODULES)} and {__name__}'), ephemeral=True)
+
     @discord.slash_command(description='Evaluate an expression')
     async def eval(self, ctx: ApplicationContext,
-                   language: Option(str, 'The language name', required=True), # type: ignore
+                   language: Option(str, 'The language name, several separated by commas to compare them', required=True, autocomplete=language_autocomplete), # type: ignore
                    expression: Option(str, 'The expression to evaluate', required=True), # type: ignore
                    display: Option(bool, 'Display the result for everyone to see', required=False)): # type: ignore
-        await self.evaluate(ctx, language, expression, not display)
+        names = split_languages(language)
+        if len(names) > 1:
+            await self.evaluate_many(ctx, names, expression, not display)
+        else:
+            # i.e. `py,` or ` py`, nothing left is reported as an invalid language
+            await self.evaluate(ctx, names[0] if len(names) == 1 else language, expression, not display)
 
-    @discord.message_command(description='Run the code block in this message')
+    @discord.message_command(description='Run the code block or attached file in this message')
     async def run(self, ctx: ApplicationContext, message: discord.Message):
         await self.process_run_command(ctx, message, True)
     
-    @discord.message_command(description='Run the code block in this message and display the result for all to see')
+    @discord.message_command(description='Run the code block or attached file in this message and display the result for all to see')
     async def run_show(self, ctx: ApplicationContext, message: discord.Message):
         await self.process_run_command(ctx, message, False)
     
-    async def process_run_command(self, ctx: ApplicationContext, message: discord.Message, ephemeral: bool):
-        content = message.system_content.split('```')
-        if len(content) < 3:
-            await self.send_error_message(ctx, 'No code block', 'Could not find valid codeblock in this message')
-            return
-        if len(content) > 3:
-            await self.send_error_message(ctx, 'Multiple code blocks', 'Multiple code blocks found in this message')
-            return
-        prefix, code, _ = content
-        prefix = prefix.strip()
-        lang = None
-        if '\n' in code and code[0].isalnum():
-            lang, code = code.split('\n', maxsplit=1)
-            lang = lang.strip()
-        if prefix[-1] == '`':
-            split = prefix.rsplit('`')
-            if len(split) >= 3:
-                *_, langblob, _ = split
-                langblob = langblob.strip()
-                if langblob.startswith('lang:') or langblob.startswith('language:'):
-                    _, lang = langblob.split(':')
-        await self.evaluate(ctx, lang, code, ephemeral)
-
-    async def evaluate(self, ctx: ApplicationContext, lang: str, code: str, ephemeral: bool):
+    @discord.message_command(description='Run the code in this message and run it again whenever you edit the message')
+    async def run_watch(self, ctx: ApplicationContext, message: discord.Message):
+        await self.process_run_command(ctx, message, True, watch=True)
+
+    async def process_run_command(self, ctx: ApplicationContext, message: discord.Message, ephemeral: bool, watch: bool = False):
+        if not watch:
+            await self.run_message(ctx, message, ephemeral)
+            return
+        if message.author.id != ctx.author.id:
+            await self.send_error_message(ctx, 'Invalid permission', 'Only the author of a message can watch it')
+            return
+        old = self.watches.pop(message.id, None)
+        if old is not None:
+            self.cancel_timers(old)
+        current = Watch(WatchContext(ctx), ephemeral, message_digest(message))
+        current.expiry = asyncio.get_running_loop().call_later(config.WATCH_DURATION_MS / 1000.0, self.unwatch, message.id, current)
+        self.watches[message.id] = current
+        # an edit during this run cancels it, so it is not awaited here
+        self.start_run(current, self.run_message(current.ctx, message, ephemeral))
+
+    def start_run(self, watch: Watch, run: Awaitable):
+        # nobody awaits a watched run, its errors are logged here
+        watch.task = asyncio.create_task(run)
+        watch.task.add_done_callback(log_failed_run)
+
+    def cancel_timers(self, watch: Watch):
+        for timer in (watch.pending, watch.expiry):
+            if timer is not None:
+                timer.cancel()
+
+    def unwatch(self, message_id: int, watch: Watch):
+        if self.watches.get(message_id) is watch:
+            del self.watches[message_id]
+            self.cancel_timers(watch)
+            if watch.task is not None:
+                watch.task.cancel()
+
+    def rerun(self, watch: Watch, message: discord.Message):
+        watch.pending = None
+        digest = message_digest(message)
+        if digest == watch.digest:
+            return
+        watch.digest = digest
+        if watch.task is not None and not watch.task.done():
+            # the conversation of the older version is told to stop, freeing the client for this one
+            watch.task.cancel()
+        self.start_run(watch, self.run_again(watch, message))
+
+    async def run_again(self, watch: Watch, message: discord.Message):
+        # the first run may have been cancelled before it responded, discord waits 3s at most
+        await watch.ctx.defer(ephemeral=watch.ephemeral)
+        await self.run_message(watch.ctx, message, watch.ephemeral)
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        watch = self.watches.get(payload.message_id)
+        if watch is None:
+            return
+        # only the last of several quick edits runs
+        if watch.pending is not None:
+            watch.pending.cancel()
+        watch.pending = asyncio.get_running_loop().call_later(config.WATCH_DEBOUNCE_MS / 1000.0, self.rerun, watch, payload.new_message)
+
+    async def run_message(self, ctx: ApplicationContext, message: discord.Message, ephemeral: bool):
+        blocks = parse_code_blocks(message.system_content)
+        attachments = readable_attachments(message)
+        if len(blocks) > config.MAX_BATCH_BLOCKS:
+            await self.send_error_message(ctx, 'Too many code blocks', f'At most {config.MAX_BATCH_BLOCKS} code blocks can be run at once')
+            return
+        if len(blocks) > 1:
+            # blocks of a batch run on their own, there is no single run the files would belong to
+            if len(attachments) > 0:
+                await self.send_error_message(ctx, 'Attachments in a batch', 'Attached files can only be run with a single code block, remove them or split the message')
+                return
+            await self.evaluate_batch(ctx, blocks, ephemeral)
+            return
+        # downloading attachments can take longer than discord's 3s interaction window, so those runs defer first
+        deferred = len(attachments) > 0
+        if deferred:
+            await ctx.defer(ephemeral=ephemeral)
+        files = await self.read_attachments(attachments)
+        if len(blocks) == 0:
+            if len(files) == 0:
+                await self.send_error_message(ctx, 'No code block', 'Could not find valid codeblock or attached file in this message')
+                return
+            # run the first attached file, its extension names the language unless overridden
+            main = files.pop(0)
+            lang = lang_override(message.system_content)
+            if lang is None and '.' in main.name:
+                lang = main.name.rsplit('.', maxsplit=1)[1]
+            await self.evaluate(ctx, lang, main.content, ephemeral, files, deferred)
+        else:
+            await self.evaluate(ctx, blocks[0].lang, blocks[0].code, ephemeral, files, deferred)
+
+    async def read_attachments(self, attachments: list[discord.Attachment]) -> list[SourceFile]:
+        files = []
+        for attachment in attachments:
+            data = await attachment.read()
+            files.append(SourceFile(attachment.filename, data.decode(errors='replace')))
+        return files
+
+    async def evaluate(self, ctx: ApplicationContext, lang: str, code: str, ephemeral: bool, files: list[SourceFile]|None = None, deferred: bool = False):
+        if files is None:
+            files = []
         if not await self.has_permissions(ctx.author, Permissions.EVAL_SCRIPT):
             await self.send_error_message(ctx, 'Invalid permission', 'You do not have permission to evaluate code')
             return
-        language = await self.store.find_lang(lang)
+        language = self.store.find_lang(lang)
         if language is None:
             await self.send_error_message(ctx, 'Invalid language', f'No such language `{lang}` registered')
-        convo = await self.server.conversation(language.key)
-        if convo is None:
-            await self.send_error_message(ctx, 'Client offline', f'{language.name}\'s client is currently not available')
             return
+        start = time.perf_counter()
+        pool = self.server.pool(language.key)
+        if pool is None:
+            await self.finish_evaluation(language, start, 'Client offline', self.send_error_message(ctx, 'Client offline', f'{language.name}\'s client is currently not available'))
+            return
+        if not pool.healthy:
+            await self.finish_evaluation(language, start, 'Client unhealthy', self.send_error_message(ctx, 'Client unhealthy', f'{language.name}\'s client stopped responding, try again later'))
+            return
+        if pool.is_full():
+            await self.finish_evaluation(language, start, 'Client busy', self.send_error_message(ctx, 'Client busy', f'{language.name}\'s client is busy, try again later'))
+            return
+        retry_after = self.scheduler.admit(ctx.author.id)
+        if retry_after > 0:
+            await self.finish_evaluation(language, start, 'Rate limited', self.send_error_message(ctx, 'Rate limited', f'You are evaluating too much, try again in {retry_after:.1f}s'))
+            return
+        output = Output()
+        if pool.cache_ttl > 0:
+            response_fut = self.cache.fetch(language.key, code, files, pool.cache_ttl, lambda: self.request_evaluation(language, code, files, ctx.author.id, output))
+        else:
+            response_fut = asyncio.ensure_future(self.request_evaluation(language, code, files, ctx.author.id, output))
+        edited = False
+        async def stream_progress():
+            # shows output while the client is still running, at most one edit per STREAM_EDIT_INTERVAL_MS
+            nonlocal edited
+            while True:
+                await output.changed.wait()
+                output.changed.clear()
+                if output.result is not None:
+                    return
+                await ctx.edit(embed=renderer.progress_embed(language.name, output))
+                edited = True
+                await asyncio.sleep(config.STREAM_EDIT_INTERVAL_MS / 1000.0)
+        progress = None
+        delete_after = None if ephemeral else config.ERROR_MSG_DELETE_AFTER_MS / 1000.0
+        try:
+            if deferred or await self.defer_unless_done(ctx, response_fut, ephemeral, start):
+                progress = asyncio.create_task(stream_progress())
+            response: Output = await response_fut
+        except asyncio.CancelledError:
+            # waiting for the defer does not cancel the request by itself
+            response_fut.cancel()
+            raise
+        except EVALUATION_FAILURES as e:
+            title, message = self.describe_failure(language, e)
+            await self.finish_evaluation(language, start, title, self.send_error_message(ctx, title, message, ephemeral=ephemeral, delete_after=delete_after, edit=edited))
+            return
+        finally:
+            if progress is not None:
+                progress.cancel()
+        if response.result.kind == protocol.ErrorMessage.kind:
+            await self.finish_evaluation(language, start, 'Client error', self.send_error_message(ctx, 'Client error', f'Client experienced exception during evaluation', ephemeral=ephemeral, delete_after=delete_after, edit=edited))
+            return
+        if response.result.kind != protocol.ResultMessage.kind:
+            await self.finish_evaluation(language, start, 'Client error', self.send_error_message(ctx, 'Client error', f'Response is invalid', ephemeral=ephemeral, delete_after=delete_after, edit=edited))
+            return
+        await self.finish_evaluation(language, start, 'Evaluation', self.send_result(ctx, response, ephemeral, edit=edited))
+
+    async def defer_unless_done(self, ctx: ApplicationContext, future: asyncio.Future, ephemeral: bool, start: float) -> bool:
+        # a result that arrives before the deadline is sent as the first response, saving the defer round trip
+        remaining = config.FAST_RESPONSE_MS / 1000.0 - (time.perf_counter() - start)
+        if remaining > 0 and not future.done():
+            await asyncio.wait((future,), timeout=remaining)
+        if future.done():
+            return False
+        # the evaluation keeps running while the defer is sent
+        await ctx.defer(ephemeral=ephemeral)
+        return True
+
+    async def finish_evaluation(self, language: Language, start: float, title: str, respond: Awaitable):
+        # sends the response and records how long it and the whole evaluation took
+        respond_start = time.perf_counter()
+        await respond
+        now = time.perf_counter()
+        metrics.RESPOND_SECONDS.observe(now - respond_start, language.name)
+        metrics.EVALUATION_SECONDS.observe(now - start, language.name)
+        metrics.EVALUATIONS.inc(language.name, outcome_label(title))
+
+    async def evaluate_many(self, ctx: ApplicationContext, names: list[str], code: str, ephemeral: bool):
+        # runs the snippet on every language at once, the table is filled in as they finish
+        if not await self.has_permissions(ctx.author, Permissions.EVAL_SCRIPT):
+            await self.send_error_message(ctx, 'Invalid permission', 'You do not have permission to evaluate code')
+            return
+        if len(names) > config.MAX_FANOUT_LANGUAGES:
+            await self.send_error_message(ctx, 'Too many languages', f'At most {config.MAX_FANOUT_LANGUAGES} languages can be compared at once')
+            return
+        languages: list[Language] = []
+        for name in names:
+            language = self.store.find_lang(name)
+            if language is None:
+                await self.send_error_message(ctx, 'Invalid language', f'No such language `{name}` registered')
+                return
+            if language not in languages:
+                languages.append(language)
+        retry_after = self.scheduler.admit(ctx.author.id, len(languages))
+        if retry_after > 0:
+            await self.send_error_message(ctx, 'Rate limited', f'You are evaluating too much, try again in {retry_after:.1f}s')
+            return
+        start = time.perf_counter()
+        # one deadline for all languages, each still gets at most its own timeout
+        deadline = start + config.FANOUT_DEADLINE_MS / 1000.0
+        rows = [[language.name, 'running', None, ''] for language in languages]
+        async def run_language(row: list, language: Language):
+            pool = self.server.pool(language.key)
+            if pool is None:
+                title = 'Client offline'
+            elif not pool.healthy:
+                title = 'Client unhealthy'
+            elif pool.is_full():
+                title = 'Client busy'
+            else:
+                output = Output()
+                try:
+                    if pool.cache_ttl > 0:
+                        output = await self.cache.fetch(language.key, code, [], pool.cache_ttl, lambda: self.request_evaluation(language, code, [], ctx.author.id, output, deadline))
+                    else:
+                        output = await self.request_evaluation(language, code, [], ctx.author.id, output, deadline)
+                    title = renderer.outcome_title(output)
+                    row[3] = renderer.preview(output)
+                except EVALUATION_FAILURES as e:
+                    # the shared deadline may end the evaluation before the language's own timeout
+                    title, row[3] = self.describe_failure(language, e, min(timeout_ms(language), config.FANOUT_DEADLINE_MS))
+            row[1] = renderer.status(output) if title == 'Evaluation' else title.removeprefix('Client ').lower()
+            row[2] = time.perf_counter() - start
+            metrics.EVALUATION_SECONDS.observe(row[2], language.name)
+            metrics.EVALUATIONS.inc(language.name, outcome_label(title))
+        tasks = { asyncio.create_task(run_language(row, language)): row for row, language in zip(rows, languages) }
+        pending = set(tasks)
+        # the evaluations are already running while the first table is sent
+        await ctx.respond(embed=renderer.fanout_embed(rows), ephemeral=ephemeral)
+        # a little slack for the clients' timeouts to arrive before the deadline cuts them off
+        cutoff = deadline + 0.5
+        while len(pending) > 0:
+            edited = time.perf_counter()
+            done, pending = await asyncio.wait(pending, timeout=max(0.0, cutoff - edited), return_when=asyncio.FIRST_COMPLETED)
+            if len(done) == 0:
+                break
+            for task in done:
+                if task.exception() is not None:
+                    # a bug rather than a client failure, it only fills this language's row
+                    row = tasks[task]
+                    print(f'Evaluating {row[0]} failed: {task.exception()!r}')
+                    row[1], row[3] = 'error', str(task.exception())[:config.FANOUT_PREVIEW_CHARS]
+            if len(pending) > 0:
+                await ctx.edit(embed=renderer.fanout_embed(rows))
+                await asyncio.sleep(max(0.0, min(config.STREAM_EDIT_INTERVAL_MS / 1000.0 - (time.perf_counter() - edited), cutoff - time.perf_counter())))
+        for task in pending:
+            # still waiting for a free connection when the deadline passed
+            task.cancel()
+        for row, language in zip(rows, languages):
+            if row[1] == 'running':
+                row[1] = 'timeout'
+                metrics.EVALUATIONS.inc(language.name, outcome_label('Client timeout'))
+        await ctx.edit(embed=renderer.fanout_embed(rows))
+
+    def evaluation_timeout(self, language: Language, deadline: float|None) -> int:
+        if deadline is None:
+            return timeout_ms(language)
+        return max(1, min(timeout_ms(language), int((deadline - time.perf_counter()) * 1000)))
+
+    async def request_evaluation(self, language: Language, code: str, files: list[SourceFile], user: int, output: Output, deadline: float|None = None) -> Output:
+        convo = await self.acquire_conversation(language, user)
+        if convo is None:
+            raise ClientDisconnected()
+        try:
+            return await self.converse(convo, code, files, output, self.evaluation_timeout(language, deadline))
+        except ClientDisconnected:
+            # retry once on another connection of the same client, unless output was already streamed
+            if output.size > 0:
+                raise
+            convo = await self.acquire_conversation(language, user)
+            if convo is None:
+                raise
+            return await self.converse(convo, code, files, output, self.evaluation_timeout(language, deadline))
+
+    async def acquire_conversation(self, language: Language, user: int) -> Conversation|None:
+        start = time.perf_counter()
+        convo = await self.scheduler.conversation(language.key, user)
+        metrics.QUEUE_SECONDS.observe(time.perf_counter() - start, language.name)
+        return convo
+
+    async def converse(self, convo: Conversation, code: str, files: list[SourceFile], output: Output, timeout: int) -> Output:
         async with convo:
-            await convo.send(protocol.EvaluateMessage(convo.id, code))
-            response_fut = convo.receive()
-            await ctx.defer(ephemeral=ephemeral)
-            delete_after = None if ephemeral else config.ERROR_MSG_DELETE_AFTER_MS / 1000.0
+            start = time.perf_counter()
+            await convo.send_evaluation(code, files)
             try:
-                response: protocol.ResultMessage = await asyncio.wait_for(response_fut, timeout=config.EVAL_TIMEOUT_MS / 1000.0)
+                async with asyncio.timeout(timeout / 1000.0):
+                    while True:
+                        message = await convo.receive()
+                        if message.kind == protocol.OutputChunkMessage.kind:
+                            output.write(message.stream, message.data)
+                            continue
+                        self.record_answer(convo, message, start)
+                        output.finish(message)
+                        return output
             except asyncio.TimeoutError:
-                response_fut.close()
+                self.record_timeout(convo)
                 await convo.send(protocol.TimeoutMessage(convo.id))
-                await self.send_error_message(ctx, 'Client timeout', f'Client did not finish within allowed timeframe of {config.EVAL_TIMEOUT_MS / 1000.0}s', ephemeral=ephemeral, delete_after=delete_after)
-                return
-            if response.kind == protocol.ErrorMessage.kind:
-                await self.send_error_message(ctx, 'Client error', f'Client experienced exception during evaluation', ephemeral=ephemeral, delete_after=delete_after)
-                return
-            if response.kind != protocol.ResultMessage.kind:
-                await self.send_error_message(ctx, 'Client error', f'Response is invalid', ephemeral=ephemeral, delete_after=delete_after)
-                return
-            files = []
-            if response.success:
-                if response.exit_code is None:
-                    embed = discord.Embed(color=config.DISCORD_OK_COLOR, title='Evaluation successful')
-                else:
-                    embed = discord.Embed(color=config.DISCORD_OK_COLOR, title=f'Evaluation finished with code {response.exit_code}')
-                if response.stdout is not None:
-                    if len(response.stdout) < config.MAX_EMBED_FIELD_SIZE - 10:
-                        embed.add_field(name='stdout', value=f'```\n{response.stdout}```')
-                    else:
-                        if ephemeral:
-                            embed.add_field(name='stdout (truncated, run in visible mode to get files)', value=f'```\n...\n{response.stdout[-int(config.MAX_EMBED_FIELD_SIZE/2):].strip()}```')
-                        else:
-                            embed.add_field(name='stdout (truncated)', value=f'```\n...\n{response.stdout[-int(config.MAX_EMBED_FIELD_SIZE/2):].strip()}```')
-                            files.append(discord.File(text_to_memfile(response.stdout), filename='stdout.txt'))
-                if response.stderr is not None:
-                    if len(response.stderr) < config.MAX_EMBED_FIELD_SIZE - 10:
-                        embed.add_field(name='stderr', value=f'```\n{response.stderr}```')
-                    else:
-                        if ephemeral:
-                            embed.add_field(name='stderr (truncated, run in visible mode to get files)', value=f'```\n...\n{response.stderr[-int(config.MAX_EMBED_FIELD_SIZE/2):].strip()}```')
-                        else:
-                            embed.add_field(name='stderr (truncated)', value=f'```\n...\n{response.stderr[-int(config.MAX_EMBED_FIELD_SIZE/2):].strip()}```')
-                            files.append(discord.File(text_to_memfile(response.stderr), filename='stderr.txt'))
+                raise
+            except asyncio.CancelledError:
+                await self.abandon(convo)
+                raise
+
+    async def abandon(self, convo: Conversation):
+        # the run was superseded, the client stops working on it
+        try:
+            await convo.send(protocol.TimeoutMessage(convo.id))
+        except ClientDisconnected:
+            pass
+
+    def record_answer(self, convo: Conversation, message: protocol.Message, start: float):
+        convo.client.record_success()
+        metrics.CLIENT_SECONDS.observe(time.perf_counter() - start, convo.client.language)
+        if message.kind == protocol.ErrorMessage.kind:
+            metrics.CLIENT_ERRORS.inc(convo.client.language)
+
+    def record_timeout(self, convo: Conversation):
+        convo.client.record_timeout()
+        metrics.TIMEOUTS.inc(convo.client.language)
+
+    async def evaluate_batch(self, ctx: ApplicationContext, blocks: list[CodeBlock], ephemeral: bool, deferred: bool = False):
+        if not await self.has_permissions(ctx.author, Permissions.EVAL_SCRIPT):
+            await self.send_error_message(ctx, 'Invalid permission', 'You do not have permission to evaluate code')
+            return
+        # blocks of the same language go to their client as one batch, different languages run concurrently
+        outcomes: list[Output|tuple[str, str]|None] = [None] * len(blocks)
+        groups: dict[str, tuple[Language, list[int]]] = {}
+        names: list[str|None] = [None] * len(blocks)
+        start = time.perf_counter()
+        for i, block in enumerate(blocks):
+            language = self.store.find_lang(block.lang)
+            if language is None:
+                outcomes[i] = ('Invalid language', f'No such language `{block.lang}` registered')
             else:
-                if response.error is None:
-                    embed = discord.Embed(color=config.DISCORD_ERR_COLOR, title='Compilation failed')
-                else:
-                    if len(response.error) < config.MAX_EMBED_DESCRIPTION_SIZE - 10:
-                        embed = discord.Embed(color=config.DISCORD_ERR_COLOR, title='Compilation failed', description=f'```\n{response.error}```')
-            if ephemeral:
-                await ctx.respond(embed=embed, ephemeral=True)
+                names[i] = language.name
+                groups.setdefault(language.key, (language, []))[1].append(i)
+        # every block that runs is an evaluation of its own
+        retry_after = self.scheduler.admit(ctx.author.id, sum(len(indices) for _, indices in groups.values()))
+        if retry_after > 0:
+            await self.send_error_message(ctx, 'Rate limited', f'You are evaluating too much, try again in {retry_after:.1f}s')
+            return
+        async def run_group(language: Language, indices: list[int]):
+            if self.server.pool(language.key) is None:
+                results = [('Client offline', f'{language.name}\'s client is currently not available')] * len(indices)
             else:
-                await ctx.respond(embed=embed, files=files, ephemeral=False)
+                try:
+                    results = await self.request_batch(language, [blocks[i].code for i in indices], ctx.author.id)
+                except EVALUATION_FAILURES as e:
+                    results = [self.describe_failure(language, e)] * len(indices)
+            for i, result in zip(indices, results):
+                if isinstance(result, BaseException):
+                    result = self.describe_failure(language, result)
+                outcomes[i] = result
+        running = asyncio.gather(*(run_group(language, indices) for language, indices in groups.values()))
+        try:
+            if not deferred:
+                await self.defer_unless_done(ctx, running, ephemeral, start)
+            await running
+        except asyncio.CancelledError:
+            running.cancel()
+            raise
+        # all embeds of a message share one size limit
+        field_size = min(config.MAX_EMBED_FIELD_SIZE, (config.MAX_MESSAGE_EMBEDS_SIZE - 100 * len(blocks)) // (2 * len(blocks)))
+        embeds = []
+        files = []
+        for i, (block, outcome) in enumerate(zip(blocks, outcomes)):
+            if isinstance(outcome, Output):
+                embed, result_files = await renderer.render(outcome, ephemeral, field_size, f'{i + 1}_')
+                files += result_files
+            else:
+                embed = renderer.error_embed(outcome[0], outcome[1])
+            embed.set_author(name=f'Block {i + 1}' if block.lang is None else f'Block {i + 1} ({block.lang})')
+            embeds.append(embed)
+        respond_start = time.perf_counter()
+        if ephemeral:
+            await ctx.respond(embeds=embeds, ephemeral=True)
+        else:
+            await ctx.respond(embeds=embeds, files=files, ephemeral=False)
+        now = time.perf_counter()
+        for name, embed in zip(names, embeds):
+            if name is not None:
+                metrics.RESPOND_SECONDS.observe(now - respond_start, name)
+                metrics.EVALUATION_SECONDS.observe(now - start, name)
+                metrics.EVALUATIONS.inc(name, outcome_label(embed.title))
+
+    async def request_batch(self, language: Language, codes: list[str], user: int) -> list[Output|BaseException]:
+        pool = self.server.pool(language.key)
+        if pool is None:
+            raise ClientDisconnected()
+        if pool.version < 3:
+            # clients without batch support get one conversation per block
+            return await asyncio.gather(*(self.request_evaluation(language, code, [], user, Output()) for code in codes), return_exceptions=True)
+        convo = await self.acquire_conversation(language, user)
+        if convo is None:
+            raise ClientDisconnected()
+        async with convo:
+            start = time.perf_counter()
+            await convo.send(protocol.EvaluateBatchMessage(convo.id, codes))
+            try:
+                async with asyncio.timeout(timeout_ms(language) / 1000.0):
+                    message = await convo.receive()
+                    while message.kind == protocol.OutputChunkMessage.kind:
+                        message = await convo.receive()
+                    self.record_answer(convo, message, start)
+            except asyncio.TimeoutError:
+                self.record_timeout(convo)
+                await convo.send(protocol.TimeoutMessage(convo.id))
+                raise
+            except asyncio.CancelledError:
+                await self.abandon(convo)
+                raise
+        if message.kind == protocol.BatchResultMessage.kind and len(message.results) == len(codes):
+            results = message.results
+        else:
+            # an error or an invalid answer applies to every block
+            results = [message] * len(codes)
+        outputs = []
+        for result in results:
+            output = Output()
+            output.finish(result)
+            outputs.append(output)
+        return outputs
+
+    def describe_failure(self, language: Language, e: Exception, timeout: int|None = None) -> tuple[str, str]:
+        # timeout is the limit the evaluation actually had, if something shorter than the language's own cut it off
+        match e:
+            case asyncio.TimeoutError():
+                return 'Client timeout', f'Client did not finish within allowed timeframe of {(timeout_ms(language) if timeout is None else timeout) / 1000.0}s'
+            case ClientDisconnected():
+                return 'Client offline', f'{language.name}\'s client disconnected during evaluation'
+            case ClientUnhealthy():
+                return 'Client unhealthy', f'{language.name}\'s client stopped responding, try again later'
+            case ClientBusy():
+                return 'Client busy', f'{language.name}\'s client is busy, try again later'
+            case QueueTimeout():
+                return 'Client busy', f'{language.name}\'s client did not accept the evaluation within {config.QUEUE_TIMEOUT_MS / 1000.0}s, try again later'
+            case UnsupportedByClient():
+                return 'Client outdated', e.message
+            case _:
+                raise e
+
+    async def send_result(self, ctx: ApplicationContext, output: Output, ephemeral: bool, edit: bool = False):
+        embed, files = await renderer.render(output, ephemeral)
+        if edit:
+            await ctx.edit(embed=embed, files=[] if ephemeral else files)
+        elif ephemeral:
+            await ctx.respond(embed=embed, ephemeral=True)
+        else:
+            await ctx.respond(embed=embed, files=files, ephemeral=False)
 
     async def has_permissions(self, member: discord.Member, permission: int):
         match permission:
@@ -181,12 +725,19 @@ class LanguageCog(commands.Cog): # command_attrs=dict(guild_ids=config.TEST_GUIL
             case Permissions.EVAL_SCRIPT:
                 return True # anyone may eval
     
-    async def send_error_message(self, ctx: ApplicationContext, title: str, message: str, ephemeral=True, delete_after=None):
-        embed = discord.Embed(color=config.DISCORD_ERR_COLOR, title=title, description=message)
-        await ctx.respond(embed=embed, ephemeral=ephemeral, delete_after=delete_after)
+    async def send_error_message(self, ctx: ApplicationContext, title: str, message: str, ephemeral=True, delete_after=None, edit=False):
+        embed = renderer.error_embed(title, message)
+        if edit:
+            await ctx.edit(embed=embed, delete_after=delete_after)
+        else:
+            await ctx.respond(embed=embed, ephemeral=ephemeral, delete_after=delete_after)
 
     @commands.Cog.listener()
     async def on_ready(self):
         print('=================')
         print(f'{self.bot.user.name} ready')
-        print('=================')
\ No newline at end of file
+        print('=================')
+
+def setup(bot: discord.Bot):
+    # main.py attaches the server, store and cache to the bot so they outlive a /reload
+    bot.add_cog(LanguageCog(bot, bot.hook_server, bot.store, bot.eval_cache))
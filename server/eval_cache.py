@@ -0,0 +1,114 @@
+from collections import OrderedDict
+from typing import Awaitable, Callable
+import hashlib
+import asyncio
+import time
+
+import config
+import protocol
+from output import Output
+from sources import SourceFile
+
+class CacheEntry:
+    __slots__ = ('result', 'size', 'expires')
+
+    def __init__(self, result: Output, size: int, expires: float):
+        self.result = result
+        self.size = size
+        self.expires = expires
+
+def result_size(result: Output) -> int:
+    size = result.size
+    if result.result.error is not None:
+        size += len(result.result.error)
+    return size
+
+class EvalCache:
+    def __init__(self):
+        self.entries: OrderedDict[tuple[str, bytes], CacheEntry] = OrderedDict()
+        self.in_flight: dict[tuple[str, bytes], asyncio.Task] = {}
+        # how many requests still wait for each in flight task
+        self.waiting: dict[asyncio.Task, int] = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def cache_key(self, key: str, code: str, files: list[SourceFile]) -> tuple[str, bytes]:
+        hash = hashlib.sha256(code.encode())
+        for file in files:
+            hash.update(b'\0' + file.name.encode() + b'\0' + file.content.encode())
+        return key, hash.digest()
+
+    def get(self, cache_key: tuple[str, bytes]) -> Output|None:
+        entry = self.entries.get(cache_key)
+        if entry is None:
+            return None
+        if entry.expires < time.monotonic():
+            self.remove(cache_key)
+            return None
+        self.entries.move_to_end(cache_key)
+        return entry.result
+
+    def put(self, cache_key: tuple[str, bytes], result: Output, ttl_ms: int):
+        size = result_size(result)
+        if size > config.EVAL_CACHE_MAX_ENTRY_BYTES or not result.in_memory:
+            return
+        self.remove(cache_key)
+        self.entries[cache_key] = CacheEntry(result, size, time.monotonic() + ttl_ms / 1000.0)
+        self.size += size
+        while len(self.entries) > config.EVAL_CACHE_MAX_ENTRIES or self.size > config.EVAL_CACHE_MAX_BYTES:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+
+    def remove(self, cache_key: tuple[str, bytes]):
+        entry = self.entries.pop(cache_key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def invalidate(self, key: str):
+        for cache_key in [cache_key for cache_key in self.entries if cache_key[0] == key]:
+            self.remove(cache_key)
+
+    def fetch(self, key: str, code: str, files: list[SourceFile], ttl_ms: int, producer: Callable[[], Awaitable[Output]]) -> asyncio.Future:
+        # serve from the cache, or share the result of an identical request that is already in flight
+        cache_key = self.cache_key(key, code, files)
+        result = self.get(cache_key)
+        if result is not None:
+            self.hits += 1
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(result)
+            return future
+        if cache_key in self.in_flight:
+            self.coalesced += 1
+            return self.share(self.in_flight[cache_key])
+        self.misses += 1
+        # the request runs in its own task so a cancelled waiter does not cancel it for everyone else
+        task = asyncio.ensure_future(producer())
+        self.in_flight[cache_key] = task
+        task.add_done_callback(lambda task: self.finish(cache_key, task, ttl_ms))
+        return self.share(task)
+
+    def share(self, task: asyncio.Task) -> asyncio.Future:
+        self.waiting[task] = self.waiting.get(task, 0) + 1
+        future = asyncio.shield(task)
+        future.add_done_callback(lambda future: self.leave(task, future))
+        return future
+
+    def leave(self, task: asyncio.Task, future: asyncio.Future):
+        self.waiting[task] -= 1
+        if self.waiting[task] > 0:
+            return
+        del self.waiting[task]
+        # once the last waiter is cancelled nobody needs the result, i.e. a superseded watch run
+        if future.cancelled() and not task.done():
+            task.cancel()
+
+    def finish(self, cache_key: tuple[str, bytes], task: asyncio.Task, ttl_ms: int):
+        if self.in_flight.get(cache_key) is task:
+            del self.in_flight[cache_key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        result = task.result()
+        if result.result.kind == protocol.ResultMessage.kind:
+            self.put(cache_key, result, ttl_ms)
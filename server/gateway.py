@@ -0,0 +1,315 @@
+from websockets.asyncio.server import serve, ServerConnection
+from websockets.exceptions import ConnectionClosed
+import asyncio
+import marshal
+import struct
+import json
+import sys
+import os
+
+import config
+if __name__ == '__main__':
+    # a worker runs this file as a script, protocol.py is one directory up
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import protocol
+
+# every frame between the bot and a worker: payload length, frame kind, connection id of the worker
+HEADER = struct.Struct('!IBI')
+LATENCY = struct.Struct('!d')
+# MESSAGE and INVALID payloads start with the size of the client's websocket message
+SIZE = struct.Struct('!I')
+
+class Frame:
+    # a client connected to the worker, the payload is its remote address as json
+    OPEN = 1
+    # a websocket message to the client, sent by the bot
+    TEXT = 2
+    BINARY = 3
+    # the client went away when sent by a worker, close the connection when sent by the bot
+    CLOSE = 4
+    PING = 5
+    # answer to PING, the payload is the round trip time
+    PONG = 6
+    # a client message the worker parsed and validated, the payload is its flattened fields in marshal format
+    MESSAGE = 7
+    # a client message that failed to parse or validate, the payload is the error
+    INVALID = 8
+    # the worker is serving WS_PORT, sent once with connection id 0
+    READY = 9
+
+async def read_frame(reader: asyncio.StreamReader) -> tuple[int, int, bytes]:
+    length, kind, connection = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return kind, connection, await reader.readexactly(length) if length > 0 else b''
+
+def write_frame(writer: asyncio.StreamWriter, kind: int, connection: int, payload: bytes = b''):
+    writer.writelines((HEADER.pack(len(payload), kind, connection), payload))
+
+# every slot of a message type, in the order flatten sends them
+SLOTS: dict[tuple[str, str], tuple[type, tuple[str, ...]]] = { key: (message_type, tuple(name for base in reversed(message_type.__mro__) for name in getattr(base, '__slots__', ())))
+                                                              for key, message_type in protocol.MESSAGE_TYPES.items() }
+# slots that hold a list of messages
+NESTED = { protocol.BatchResultMessage: 'results' }
+
+def flatten(message: protocol.Message) -> tuple:
+    # side, kind and slot values of a validated message
+    values = [getattr(message, name) for name in SLOTS[message.side, message.kind][1]]
+    nested = NESTED.get(type(message))
+    if nested is not None:
+        index = SLOTS[message.side, message.kind][1].index(nested)
+        values[index] = [flatten(item) for item in values[index]]
+    return message.side, message.kind, tuple(values)
+
+def unflatten(fields: tuple) -> protocol.Message:
+    # the worker validated the message already, its slots are set without checking them again
+    side, kind, values = fields
+    message_type, names = SLOTS[side, kind]
+    message = message_type.__new__(message_type)
+    for name, value in zip(names, values):
+        setattr(message, name, value)
+    nested = NESTED.get(message_type)
+    if nested is not None:
+        setattr(message, nested, [unflatten(item) for item in getattr(message, nested)])
+    return message
+
+class ParsedMessage:
+    # a client message as it arrives from a worker, ClientHookServer.handle_client takes it in place of the raw frame
+    __slots__ = ('size', 'fields', 'error')
+
+    def __init__(self, size: int, fields: tuple|None, error: str|None = None):
+        self.size = size
+        self.fields = fields
+        self.error = error
+
+    def __len__(self) -> int:
+        return self.size
+
+    def message(self) -> protocol.Message:
+        if self.error is not None:
+            raise ValueError(self.error)
+        return unflatten(self.fields)
+
+class GatewaySocket:
+    # a client websocket held by a worker, ClientHookServer.handle_client uses it like a ServerConnection
+    def __init__(self, link: 'WorkerLink', id: int, remote_address: tuple):
+        self.link = link
+        self.id = id
+        self.remote_address = remote_address
+        self.incoming: asyncio.Queue[ParsedMessage|None] = asyncio.Queue()
+        self.closed = False
+        self.pong: asyncio.Future|None = None
+
+    async def send(self, message: str|bytes):
+        if self.closed:
+            raise ConnectionClosed(None, None)
+        write_frame(self.link.writer, Frame.TEXT if isinstance(message, str) else Frame.BINARY, self.id, message.encode() if isinstance(message, str) else message)
+        try:
+            await self.link.writer.drain()
+        except ConnectionError:
+            raise ConnectionClosed(None, None)
+
+    async def ping(self) -> asyncio.Future:
+        if self.closed:
+            raise ConnectionClosed(None, None)
+        # only the latest ping is answered, an older one has timed out already
+        self.pong = asyncio.get_running_loop().create_future()
+        write_frame(self.link.writer, Frame.PING, self.id)
+        return self.pong
+
+    async def close(self):
+        if not self.closed:
+            write_frame(self.link.writer, Frame.CLOSE, self.id)
+
+    def ended(self):
+        self.closed = True
+        self.incoming.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> ParsedMessage:
+        message = await self.incoming.get()
+        if message is None:
+            raise StopAsyncIteration()
+        return message
+
+class WorkerLink:
+    # the bot's end of one worker's unix socket, every client of the worker gets a GatewaySocket
+    def __init__(self, server, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.sockets: dict[int, GatewaySocket] = {}
+        self.handlers: set[asyncio.Task] = set()
+
+    async def run(self):
+        try:
+            while True:
+                kind, id, payload = await read_frame(self.reader)
+                if kind == Frame.READY:
+                    # clients can connect once the first worker is up
+                    self.server.listening.set()
+                    continue
+                if kind == Frame.OPEN:
+                    socket = GatewaySocket(self, id, tuple(json.loads(payload)))
+                    self.sockets[id] = socket
+                    handler = asyncio.create_task(self.server.handle_client(socket))
+                    self.handlers.add(handler)
+                    handler.add_done_callback(self.handlers.discard)
+                    continue
+                socket = self.sockets.get(id)
+                if socket is None:
+                    continue
+                match kind:
+                    case Frame.MESSAGE:
+                        socket.incoming.put_nowait(ParsedMessage(SIZE.unpack_from(payload)[0], marshal.loads(payload[SIZE.size:])))
+                    case Frame.INVALID:
+                        socket.incoming.put_nowait(ParsedMessage(SIZE.unpack_from(payload)[0], None, payload[SIZE.size:].decode()))
+                    case Frame.CLOSE:
+                        del self.sockets[id]
+                        socket.ended()
+                    case Frame.PONG:
+                        if socket.pong is not None and not socket.pong.done():
+                            socket.pong.set_result(LATENCY.unpack(payload)[0])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print('Gateway worker disconnected')
+        finally:
+            # the clients reconnect to the other workers and resume their sessions
+            for socket in self.sockets.values():
+                socket.ended()
+            self.sockets.clear()
+            self.writer.close()
+
+class Gateway:
+    # runs the client websockets in worker processes sharing WS_PORT, the bot process keeps pools, sessions and routing
+    def __init__(self, server, workers: int):
+        self.server = server
+        self.workers = workers
+
+    async def run(self):
+        if os.path.exists(config.GATEWAY_SOCKET):
+            os.remove(config.GATEWAY_SOCKET)
+        unix = await asyncio.start_unix_server(self.accept, config.GATEWAY_SOCKET)
+        print(f'Gateway started with {self.workers} workers')
+        # the workers connect and start accepting clients on their own, the first one to serve sets server.listening
+        async with unix:
+            await asyncio.gather(*(self.supervise(index) for index in range(self.workers)))
+
+    async def accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await WorkerLink(self.server, reader, writer).run()
+        except asyncio.CancelledError:
+            # the bot is shutting down, asyncio logs a traceback for a connection callback that ends cancelled
+            pass
+
+    async def supervise(self, index: int):
+        # restarts a worker that exits, workers exit on their own once the bot's socket closes
+        while True:
+            process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), config.GATEWAY_SOCKET, str(config.WS_PORT))
+            try:
+                code = await process.wait()
+            except asyncio.CancelledError:
+                # reaped before the loop closes, otherwise asyncio warns about the orphaned child
+                process.terminate()
+                await process.wait()
+                raise
+            print(f'Gateway worker {index} exited with code {code}, restarting')
+            await asyncio.sleep(1)
+
+class GatewayWorker:
+    # accepts client websockets and forwards their messages to the bot, decompression, framing and parsing stay in this process
+    def __init__(self, path: str, port: int):
+        self.path = path
+        self.port = port
+        self.connections: dict[int, tuple[ServerConnection, asyncio.Queue[str|bytes|None]]] = {}
+        self.next_id = 0
+        self.writer: asyncio.StreamWriter|None = None
+        self.pings: set[asyncio.Task] = set()
+
+    async def run(self):
+        reader, self.writer = await asyncio.open_unix_connection(self.path)
+        compression = None if config.WS_COMPRESSION == 'none' else config.WS_COMPRESSION
+        async with serve(self.handle_client, config.WS_HOST, self.port, max_size=config.WS_MAX_FRAME_BYTES, compression=compression, reuse_port=True):
+            write_frame(self.writer, Frame.READY, 0)
+            try:
+                while True:
+                    kind, id, payload = await read_frame(reader)
+                    entry = self.connections.get(id)
+                    if entry is None:
+                        continue
+                    socket, outgoing = entry
+                    match kind:
+                        case Frame.TEXT:
+                            self.enqueue(id, socket, outgoing, payload.decode())
+                        case Frame.BINARY:
+                            self.enqueue(id, socket, outgoing, payload)
+                        case Frame.CLOSE:
+                            self.enqueue(id, socket, outgoing, None)
+                        case Frame.PING:
+                            task = asyncio.create_task(self.ping(id, socket))
+                            self.pings.add(task)
+                            task.add_done_callback(self.pings.discard)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                print('Bot disconnected, stopping gateway worker')
+
+    async def handle_client(self, socket: ServerConnection):
+        id = self.next_id
+        self.next_id = (self.next_id + 1) % 2**32
+        outgoing: asyncio.Queue[str|bytes|None] = asyncio.Queue(config.GATEWAY_MAX_QUEUED_MESSAGES)
+        self.connections[id] = (socket, outgoing)
+        write_frame(self.writer, Frame.OPEN, id, json.dumps(list(socket.remote_address)).encode())
+        sender = asyncio.create_task(self.pump(socket, outgoing))
+        try:
+            async for message in socket:
+                kind, payload = self.parse(message)
+                write_frame(self.writer, kind, id, payload)
+                await self.writer.drain()
+        except ConnectionClosed:
+            pass
+        finally:
+            sender.cancel()
+            # already gone if its queue overflowed
+            self.connections.pop(id, None)
+            write_frame(self.writer, Frame.CLOSE, id)
+
+    def parse(self, raw: str|bytes) -> tuple[int, bytes]:
+        size = SIZE.pack(len(raw))
+        try:
+            # the bot would reject it anyway, it does not have to parse it for that
+            message = protocol.decode(raw)
+            # marshal loads many times faster than json on the bot's side, and never runs code
+            return Frame.MESSAGE, size + marshal.dumps(flatten(message))
+        except ValueError as e:
+            # marshal raises ValueError for msgpack extension types
+            return Frame.INVALID, size + str(e).encode()
+
+    async def pump(self, socket: ServerConnection, outgoing: asyncio.Queue[str|bytes|None]):
+        # every connection sends from its own queue, a client that reads slowly only holds up itself
+        try:
+            while (message := await outgoing.get()) is not None:
+                await socket.send(message)
+            await socket.close()
+        except ConnectionClosed:
+            pass
+
+    def enqueue(self, id: int, socket: ServerConnection, outgoing: asyncio.Queue[str|bytes|None], message: str|bytes|None):
+        try:
+            outgoing.put_nowait(message)
+        except asyncio.QueueFull:
+            # a client that doesn't read would not answer a close handshake either. its messages are lost like on any dropped
+            # connection, it registers again and resumes its session
+            print(f'{socket.remote_address} reads too slowly, dropping its connection')
+            del self.connections[id]
+            socket.transport.abort()
+
+    async def ping(self, id: int, socket: ServerConnection):
+        try:
+            pong = await socket.ping()
+            latency = await asyncio.wait_for(pong, config.HEALTH_PING_TIMEOUT_MS / 1000.0)
+        except (asyncio.TimeoutError, ConnectionClosed):
+            return
+        if id in self.connections:
+            write_frame(self.writer, Frame.PONG, id, LATENCY.pack(latency))
+
+if __name__ == '__main__':
+    # started by Gateway.supervise with the path of the bot's unix socket and the port to serve
+    asyncio.run(GatewayWorker(sys.argv[1], int(sys.argv[2])).run())
@@ -1,27 +1,77 @@
+import time
+# startup phases are measured from here
+STARTED = time.perf_counter()
 import sys
 import os
 # make protocol.py importable
 currentdir = os.path.dirname(os.path.abspath(__file__))
 parentdir = os.path.dirname(currentdir)
-sys.path.insert(0, parentdir) 
+sys.path.insert(0, parentdir)
 
-import discord
-from discord_cog import LanguageCog
+import asyncio
+# discord is imported once the websocket server is up, nothing imported here may import it
 from client_hook import ClientHookServer
+from gateway import Gateway
+from eval_cache import EvalCache
 
 import config
+import metrics
 from store import Store
 
+class Startup:
+    # prints and exports how long each phase of the startup took
+    def __init__(self, start: float):
+        self.start = start
+        self.last = start
+
+    def phase(self, name: str):
+        now = time.perf_counter()
+        metrics.STARTUP_SECONDS.inc(name, amount=now - self.last)
+        print(f'Startup: {name} took {(now - self.last) * 1000:.0f}ms, {(now - self.start) * 1000:.0f}ms since start')
+        self.last = now
+
+async def wait_until_ready(bot, server: ClientHookServer, startup: Startup):
+    await bot.wait_until_ready()
+    startup.phase('discord ready')
+    print(f'{len(server.clients)} languages connected before the first interaction')
+
 def main():
+    startup = Startup(STARTED)
+    startup.phase('imports')
     store = Store()
+    startup.phase('store')
 
     server = ClientHookServer(store)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # clients reconnect and register while the discord connection is still being set up
+    if config.GATEWAY_WORKERS > 0:
+        serving = loop.create_task(Gateway(server, config.GATEWAY_WORKERS).run())
+    else:
+        serving = loop.create_task(server.run())
+    if config.METRICS_PORT is not None:
+        loop.create_task(metrics.serve())
+    listening = loop.create_task(server.listening.wait())
+    loop.run_until_complete(asyncio.wait((serving, listening), return_when=asyncio.FIRST_COMPLETED))
+    if serving.done():
+        # i.e. the port is taken, raises what stopped the server
+        serving.result()
+    startup.phase('websocket server')
 
-    bot = discord.Bot(intents=discord.Intents.all())
-    bot.add_cog(LanguageCog(bot, server, store))
+    import discord
+    startup.phase('discord import')
+    bot = discord.Bot(intents=discord.Intents.all(), loop=loop)
+    # these outlive the cog, /reload only swaps the cog and the modules it names
+    bot.hook_server = server
+    bot.store = store
+    bot.eval_cache = EvalCache()
+    bot.load_extension('discord_cog')
+    startup.phase('bot setup')
 
-    bot.loop.create_task(server.run())
+    loop.create_task(wait_until_ready(bot, server, startup))
     bot.run(config.BOT_TOKEN)
+    server.close()
+    store.close()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,144 @@
+from bisect import bisect_left
+import asyncio
+
+import config
+
+# upper bounds in seconds, the last bucket is +Inf
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LOOKUP_BUCKETS = (0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.0001, 0.001)
+
+metrics: list['Metric'] = []
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if len(names) == 0:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(str(value))}"' for name, value in zip(names, values)) + '}'
+
+class Metric:
+    type = ''
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # label values -> value, updated in place so recording is a dict lookup and an add
+        self.values: dict[tuple, object] = {}
+        metrics.append(self)
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{format_labels(self.labels, labels)} {value}' for labels, value in self.values.items()]
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}'] + self.samples())
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels) -> float:
+        return self.values.get(labels, 0)
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) - amount
+
+class HistogramState:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, buckets: int):
+        # per bucket, not cumulative, the last one is +Inf
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0.0
+        self.count = 0
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        state = self.values.get(labels)
+        if state is None:
+            state = HistogramState(len(self.buckets))
+            self.values[labels] = state
+        state.counts[bisect_left(self.buckets, value)] += 1
+        state.sum += value
+        state.count += 1
+
+    def count(self, *labels) -> int:
+        state = self.values.get(labels)
+        return 0 if state is None else state.count
+
+    def quantile(self, q: float, *labels) -> float|None:
+        # upper bound of the bucket the quantile falls into, None without observations
+        state = self.values.get(labels)
+        if state is None or state.count == 0:
+            return None
+        rank = q * state.count
+        seen = 0
+        for bound, count in zip(self.buckets, state.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def samples(self) -> list[str]:
+        lines = []
+        for labels, state in self.values.items():
+            seen = 0
+            for bound, count in zip(self.buckets + ('+Inf',), state.counts):
+                seen += count
+                lines.append(f'{self.name}_bucket{format_labels(self.labels + ("le",), labels + (bound,))} {seen}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, labels)} {state.sum}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, labels)} {state.count}')
+        return lines
+
+EVALUATIONS = Counter('sandbox_evaluations_total', 'Evaluations by language and outcome', ('language', 'outcome'))
+EVALUATION_SECONDS = Histogram('sandbox_evaluation_seconds', 'Time from the command to the response being sent', ('language',))
+QUEUE_SECONDS = Histogram('sandbox_queue_seconds', 'Time spent waiting for a client connection with spare capacity', ('language',))
+CLIENT_SECONDS = Histogram('sandbox_client_seconds', 'Time from sending an evaluation to the client\'s result', ('language',))
+RESPOND_SECONDS = Histogram('sandbox_discord_respond_seconds', 'Time spent sending the response to discord', ('language',))
+IN_FLIGHT = Gauge('sandbox_conversations_in_flight', 'Conversations currently open with a client', ('language',))
+TIMEOUTS = Counter('sandbox_timeouts_total', 'Evaluations the client did not finish in time', ('language',))
+CLIENT_ERRORS = Counter('sandbox_client_errors_total', 'Evaluations the client answered with an error', ('language',))
+PING_SECONDS = Histogram('sandbox_client_ping_seconds', 'Round trip time of health check pings', ('language',))
+CONNECTIONS = Gauge('sandbox_client_connections', 'Registered client connections', ('language',))
+MESSAGES_RECEIVED = Counter('sandbox_ws_messages_received_total', 'Websocket messages received from clients', ('language', 'kind'))
+MESSAGES_SENT = Counter('sandbox_ws_messages_sent_total', 'Websocket messages sent to clients', ('language', 'kind'))
+BYTES_RECEIVED = Counter('sandbox_ws_received_bytes_total', 'Size of the websocket messages received from clients', ('language',))
+BYTES_SENT = Counter('sandbox_ws_sent_bytes_total', 'Size of the websocket messages sent to clients', ('language',))
+STARTUP_SECONDS = Gauge('sandbox_startup_seconds', 'Time each phase of the last startup took', ('phase',))
+STORE_LOOKUP_SECONDS = Histogram('sandbox_store_lookup_seconds', 'Time of in-memory store lookups', ('operation',), LOOKUP_BUCKETS)
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+async def handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=5)
+        parts = request.split(b'\r\n', 1)[0].split(b' ')
+        if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def serve():
+    server = await asyncio.start_server(handle_request, config.METRICS_HOST, config.METRICS_PORT)
+    print(f'Metrics served on http://{config.METRICS_HOST}:{config.METRICS_PORT}/metrics')
+    async with server:
+        await server.serve_forever()
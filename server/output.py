@@ -0,0 +1,109 @@
+import contextlib
+import tempfile
+import asyncio
+import weakref
+import io
+import os
+
+import config
+import protocol
+
+def remove_spill(path: str):
+    # the file may be gone already, i.e. when its directory was cleaned up
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+class OutputStream:
+    # collects one output stream, keeps the tail for embeds and spills everything else to a temporary file
+    def __init__(self):
+        self.size = 0
+        self.length = 0
+        self.truncated = False
+        self.tail = ''
+        self.buffer: bytearray|None = bytearray()
+        self.path: str|None = None
+        self.file = None
+
+    def write(self, data: str, limit: int) -> int:
+        self.length += len(data)
+        self.tail = (self.tail + data)[-config.MAX_EMBED_FIELD_SIZE:]
+        raw = data.encode()
+        if len(raw) > limit:
+            # cut before the character the limit falls into, utf-8 continuation bytes start with 0b10
+            while limit > 0 and raw[limit] & 0xC0 == 0x80:
+                limit -= 1
+            raw = raw[:limit]
+            self.truncated = True
+        if len(raw) == 0:
+            return 0
+        if self.buffer is not None and len(self.buffer) + len(raw) > config.OUTPUT_SPOOL_BYTES:
+            self.spill()
+        if self.buffer is not None:
+            self.buffer += raw
+        else:
+            self.file.write(raw)
+        self.size += len(raw)
+        return len(raw)
+
+    def spill(self):
+        self.file = tempfile.NamedTemporaryFile(prefix='sandbox-output-', delete=False)
+        self.path = self.file.name
+        weakref.finalize(self, remove_spill, self.path)
+        self.file.write(self.buffer)
+        self.buffer = None
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    @property
+    def in_memory(self) -> bool:
+        return self.buffer is not None
+
+    def attachment(self, filename: str) -> 'discord.File':
+        # imported here so the websocket server can start before discord is imported
+        import discord
+        if self.buffer is not None:
+            return discord.File(io.BytesIO(self.buffer), filename=filename)
+        return discord.File(self.path, filename=filename)
+
+class Output:
+    def __init__(self):
+        self.stdout: OutputStream|None = None
+        self.stderr: OutputStream|None = None
+        self.size = 0
+        # final message of the conversation, a ResultMessage unless the client failed
+        self.result: protocol.Message|None = None
+        self.changed = asyncio.Event()
+
+    @property
+    def truncated(self) -> bool:
+        return any(stream.truncated for stream in (self.stdout, self.stderr) if stream is not None)
+
+    @property
+    def in_memory(self) -> bool:
+        return all(stream.in_memory for stream in (self.stdout, self.stderr) if stream is not None)
+
+    def write(self, name: str, data: str):
+        stream = getattr(self, name)
+        if stream is None:
+            stream = OutputStream()
+            setattr(self, name, stream)
+        self.size += stream.write(data, config.MAX_OUTPUT_BYTES - self.size)
+        self.changed.set()
+
+    def finish(self, result: protocol.Message):
+        # clients without streaming support send the whole output with the result
+        if result.kind == protocol.ResultMessage.kind:
+            if result.stdout is not None:
+                self.write('stdout', result.stdout)
+                result.stdout = None
+            if result.stderr is not None:
+                self.write('stderr', result.stderr)
+                result.stderr = None
+        for stream in (self.stdout, self.stderr):
+            if stream is not None:
+                stream.close()
+        self.result = result
+        self.changed.set()
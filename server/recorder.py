@@ -0,0 +1,126 @@
+import threading
+import queue
+import gzip
+import json
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+import protocol
+from gateway import ParsedMessage
+
+class Recorder:
+    # appends every protocol frame to gzip compressed jsonl traces, the event loop only enqueues a tuple
+    def __init__(self, prefix: str, rotate_bytes: int, payloads: bool, max_queued: int):
+        self.prefix = prefix
+        self.rotate_bytes = rotate_bytes
+        self.payloads = payloads
+        self.start = time.monotonic()
+        self.part = 0
+        # turned off when the trace can't be written, nothing is enqueued after that
+        self.recording = True
+        self.dropped = 0
+        self.queue: queue.Queue = queue.Queue(max_queued)
+        self.writer = threading.Thread(target=self.write_loop, name='trace-writer', daemon=True)
+        self.writer.start()
+
+    def record(self, direction: str, language: str, message: protocol.Message, raw: str|bytes|ParsedMessage):
+        if not self.recording:
+            return
+        # the raw frame is only kept for payloads, the message object may change after this
+        try:
+            self.queue.put_nowait((time.monotonic() - self.start, direction, language, message.id, message.kind, len(raw), raw if self.payloads else None))
+        except queue.Full:
+            self.dropped += 1
+
+    def entry(self, item: tuple) -> dict:
+        t, direction, language, id, kind, size, raw = item
+        entry = { 't': round(t, 6), 'dir': direction, 'lang': language, 'id': id, 'kind': kind, 'size': size }
+        if raw is not None:
+            if isinstance(raw, ParsedMessage):
+                # builds a copy of the message, the one the server got may change
+                message = raw.message().to_dict()
+            else:
+                message = json.loads(raw) if isinstance(raw, str) else msgpack.unpackb(raw)
+            # client keys and session tokens never end up in a trace, either one lets a trace holder impersonate the client
+            message.pop('key', None)
+            message.pop('session', None)
+            entry['message'] = message
+        return entry
+
+    def open(self):
+        self.part += 1
+        path = f'{self.prefix}-{time.strftime("%Y%m%d-%H%M%S")}-{self.part:04}.jsonl.gz'
+        print(f'Recording protocol trace to {path}')
+        return gzip.open(path, 'wt', encoding='utf-8')
+
+    def write_loop(self):
+        file = None
+        written = 0
+        dropped = 0
+        stop = False
+        while not stop:
+            try:
+                item = self.queue.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            batch = []
+            while item is not None:
+                batch.append(item)
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            stop = item is None
+            if self.dropped > dropped:
+                print(f'Trace writer fell behind, dropped {self.dropped - dropped} frames')
+                dropped = self.dropped
+            lines = []
+            for item in batch:
+                try:
+                    lines.append(json.dumps(self.entry(item), separators=(',', ':')) + '\n')
+                except Exception as e:
+                    # i.e. a msgpack bin value json can't hold, only that frame is left out
+                    print(f'Could not record {item[4]} frame: {e!r}')
+            if len(lines) == 0:
+                continue
+            try:
+                if file is None or written >= self.rotate_bytes:
+                    if file is not None:
+                        file.close()
+                    file = self.open()
+                    written = 0
+                for line in lines:
+                    file.write(line)
+                    written += len(line)
+                # a sync flush per batch keeps everything before a crash readable
+                file.flush()
+            except OSError as e:
+                # i.e. a full disk or a missing directory, later frames would fail the same way
+                print(f'Could not write protocol trace, recording stopped: {e!r}')
+                self.recording = False
+                if file is not None:
+                    try:
+                        file.close()
+                    except OSError:
+                        pass
+                return
+        if file is not None:
+            try:
+                file.close()
+            except OSError as e:
+                print(f'Could not finish protocol trace: {e!r}')
+
+    def close(self):
+        self.recording = False
+        # the writer drains the queue until it gets the sentinel, unless it already stopped
+        while self.writer.is_alive():
+            try:
+                self.queue.put(None, timeout=1.0)
+                break
+            except queue.Full:
+                continue
+        self.writer.join()
@@ -0,0 +1,127 @@
+import tempfile
+import asyncio
+import discord
+import gzip
+import io
+
+import config
+import protocol
+from output import Output, OutputStream
+
+# read size when compressing an attachment
+COPY_CHUNK_BYTES = 64 * 1024
+
+def error_embed(title: str, description: str) -> discord.Embed:
+    return discord.Embed(color=config.DISCORD_ERR_COLOR, title=title, description=description)
+
+def code_field(text: str) -> str:
+    return f'```\n{text}```'
+
+def stream_field(stream: OutputStream, field_size: int) -> tuple[str, bool]:
+    # the only pass over the tail, returns the field value and whether it was cut
+    if stream.length < field_size - 10:
+        return code_field(stream.tail), False
+    return code_field(f'...\n{stream.tail[-(field_size // 2):].strip()}'), True
+
+def compressed(stream: OutputStream, filename: str) -> discord.File:
+    # memory stays below RENDER_SPOOL_BYTES however large the output is, the rest goes to a temporary file
+    target = tempfile.SpooledTemporaryFile(max_size=config.RENDER_SPOOL_BYTES, prefix='sandbox-render-')
+    with gzip.GzipFile(filename=filename, mode='wb', fileobj=target) as archive:
+        if stream.in_memory:
+            archive.write(stream.buffer)
+        else:
+            with open(stream.path, 'rb') as source:
+                while chunk := source.read(COPY_CHUNK_BYTES):
+                    archive.write(chunk)
+    target.seek(0)
+    return discord.File(target, filename=f'{filename}.gz')
+
+def attachment(stream: OutputStream, filename: str) -> discord.File:
+    if stream.size > config.ATTACHMENT_COMPRESS_BYTES:
+        return compressed(stream, filename)
+    return stream.attachment(filename)
+
+def needs_attachments(output: Output, ephemeral: bool, field_size: int) -> bool:
+    return not ephemeral and any(stream.length >= field_size - 10 for stream in (output.stdout, output.stderr) if stream is not None)
+
+def result_embed(output: Output, ephemeral: bool, field_size: int, file_prefix: str = '') -> tuple[discord.Embed, list[discord.File]]:
+    response: protocol.ResultMessage = output.result
+    files = []
+    if response.kind == protocol.ErrorMessage.kind:
+        return error_embed('Client error', 'Client experienced exception during evaluation'), files
+    if response.kind != protocol.ResultMessage.kind:
+        return error_embed('Client error', 'Response is invalid'), files
+    if not response.success:
+        if response.error is None:
+            return error_embed('Compilation failed', None), files
+        # the error takes the place of the stdout and stderr fields, so it gets their share of the message
+        description_size = min(config.MAX_EMBED_DESCRIPTION_SIZE, 2 * field_size)
+        if len(response.error) < description_size - 10:
+            return error_embed('Compilation failed', code_field(response.error)), files
+        # the start of a compiler error is usually the relevant part
+        embed = error_embed('Compilation failed', code_field(f'{response.error[:description_size - 20]}\n...'))
+        if not ephemeral:
+            files.append(discord.File(io.BytesIO(response.error.encode()), filename=f'{file_prefix}error.txt'))
+        return embed, files
+    if response.exit_code is None:
+        embed = discord.Embed(color=config.DISCORD_OK_COLOR, title='Evaluation successful')
+    else:
+        embed = discord.Embed(color=config.DISCORD_OK_COLOR, title=f'Evaluation finished with code {response.exit_code}')
+    for name, stream in (('stdout', output.stdout), ('stderr', output.stderr)):
+        if stream is None:
+            continue
+        value, cut = stream_field(stream, field_size)
+        if not cut:
+            embed.add_field(name=name, value=value)
+        elif ephemeral:
+            embed.add_field(name=f'{name} (truncated, run in visible mode to get files)', value=value)
+        else:
+            embed.add_field(name=f'{name} (truncated)', value=value)
+            files.append(attachment(stream, f'{file_prefix}{name}.txt'))
+    if output.truncated:
+        embed.set_footer(text=f'Output was capped at {config.MAX_OUTPUT_BYTES} bytes')
+    return embed, files
+
+async def render(output: Output, ephemeral: bool, field_size: int|None = None, file_prefix: str = '') -> tuple[discord.Embed, list[discord.File]]:
+    # building attachments reads and compresses the whole output, that happens off the event loop
+    if field_size is None:
+        field_size = config.MAX_EMBED_FIELD_SIZE
+    if needs_attachments(output, ephemeral, field_size):
+        return await asyncio.get_running_loop().run_in_executor(None, result_embed, output, ephemeral, field_size, file_prefix)
+    return result_embed(output, ephemeral, field_size, file_prefix)
+
+def progress_embed(language: str, output: Output) -> discord.Embed:
+    embed = discord.Embed(color=config.DISCORD_OK_COLOR, title=f'Running {language}...')
+    for name, stream in (('stdout', output.stdout), ('stderr', output.stderr)):
+        if stream is not None and len(stream.tail) > 0:
+            embed.add_field(name=name, value=code_field(stream.tail[-(config.MAX_EMBED_FIELD_SIZE // 2):].strip()))
+    return embed
+
+def outcome_title(output: Output) -> str:
+    response = output.result
+    if response.kind != protocol.ResultMessage.kind:
+        return 'Client error'
+    return 'Evaluation' if response.success else 'Compilation failed'
+
+def status(output: Output) -> str:
+    return 'ok' if output.result.exit_code is None else f'exit {output.result.exit_code}'
+
+def preview(output: Output) -> str:
+    # last line of stdout, or stderr when there is none, short enough for one table row
+    for stream in (output.stdout, output.stderr):
+        if stream is not None and len(stream.tail.strip()) > 0:
+            line = stream.tail.strip().rsplit('\n', 1)[-1]
+            return line if len(line) <= config.FANOUT_PREVIEW_CHARS else f'{line[:config.FANOUT_PREVIEW_CHARS - 3]}...'
+    return ''
+
+def fanout_embed(rows: list[list]) -> discord.Embed:
+    # one row per language: name, status, seconds taken and a preview of the output
+    width = max(len(row[0]) for row in rows)
+    status_width = max(len(row[1]) for row in rows)
+    lines = []
+    for name, state, seconds, line in rows:
+        taken = '' if seconds is None else f'{seconds:.2f}s'
+        lines.append(f'{name:<{width}}  {state:<{status_width}}  {taken:>6}  {line}'.rstrip().replace('`', "'"))
+    running = sum(1 for row in rows if row[1] == 'running')
+    title = f'Comparing {len(rows)} languages' + (f', {running} running...' if running > 0 else '')
+    return discord.Embed(color=config.DISCORD_OK_COLOR, title=title, description=code_field('\n'.join(lines)[:config.MAX_EMBED_DESCRIPTION_SIZE - 10]))
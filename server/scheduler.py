@@ -0,0 +1,107 @@
+from collections import OrderedDict, deque
+import asyncio
+import time
+
+import config
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+class RateLimiter:
+    def __init__(self, rate: float, burst: float, max_tracked: int):
+        self.rate = rate
+        self.burst = burst
+        self.max_tracked = max_tracked
+        # least recently used first, a bucket that has refilled completely carries no state and is dropped
+        self.buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+
+    def acquire(self, user: int, tokens: int = 1) -> float:
+        # takes the tokens and returns 0, or returns the seconds until enough are available.
+        # more tokens than the burst are admitted with a full bucket and leave it in debt
+        now = time.monotonic()
+        self.expire(now)
+        bucket = self.buckets.pop(user, None)
+        if bucket is None:
+            bucket = TokenBucket(self.burst, now)
+        else:
+            bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        self.buckets[user] = bucket
+        needed = min(tokens, self.burst)
+        if bucket.tokens < needed:
+            return (needed - bucket.tokens) / self.rate
+        bucket.tokens -= tokens
+        return 0
+
+    def expire(self, now: float):
+        while len(self.buckets) > 0:
+            user, bucket = next(iter(self.buckets.items()))
+            # a bucket in debt takes longer to fill up again
+            if len(self.buckets) < self.max_tracked and bucket.tokens + (now - bucket.updated) * self.rate < self.burst:
+                break
+            del self.buckets[user]
+
+class FairQueue:
+    # round robin over users, first in first out for the requests of a single user
+    def __init__(self):
+        self.queues: dict[int, deque[asyncio.Future]] = {}
+        self.order: deque[int] = deque()
+        self.length = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def push(self, user: int, waiter: asyncio.Future):
+        queue = self.queues.get(user)
+        if queue is None:
+            queue = deque()
+            self.queues[user] = queue
+            self.order.append(user)
+        queue.append(waiter)
+        self.length += 1
+
+    def pop(self) -> asyncio.Future|None:
+        if self.length == 0:
+            return None
+        user = self.order.popleft()
+        queue = self.queues[user]
+        waiter = queue.popleft()
+        self.length -= 1
+        if len(queue) > 0:
+            self.order.append(user)
+        else:
+            del self.queues[user]
+        return waiter
+
+    def remove(self, user: int, waiter: asyncio.Future):
+        queue = self.queues.get(user)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        self.length -= 1
+        if len(queue) == 0:
+            del self.queues[user]
+            self.order.remove(user)
+
+    def clear(self) -> list[asyncio.Future]:
+        waiters = [waiter for queue in self.queues.values() for waiter in queue]
+        self.queues.clear()
+        self.order.clear()
+        self.length = 0
+        return waiters
+
+class Scheduler:
+    # sits between the cog and the ClientHookServer, rate limits users and queues them fairly per client
+    def __init__(self, server):
+        self.server = server
+        self.limiter = RateLimiter(config.EVAL_RATE_PER_MINUTE / 60.0, config.EVAL_RATE_BURST, config.EVAL_RATE_MAX_TRACKED_USERS)
+
+    def admit(self, user: int, evaluations: int = 1) -> float:
+        return self.limiter.acquire(user, evaluations)
+
+    async def conversation(self, key: str, user: int):
+        return await self.server.conversation(key, user)
@@ -0,0 +1,42 @@
+class SourceFile:
+    __slots__ = ('name', 'content')
+
+    def __init__(self, name: str, content: str):
+        self.name = name
+        self.content = content
+
+class CodeBlock:
+    __slots__ = ('lang', 'code')
+
+    def __init__(self, lang: str|None, code: str):
+        self.lang = lang
+        self.code = code
+
+def lang_override(text: str) -> str|None:
+    # a `lang:x` or `language:x` inline code block at the end of the text
+    text = text.strip()
+    if not text.endswith('`'):
+        return None
+    split = text.rsplit('`')
+    if len(split) < 3:
+        return None
+    langblob = split[-2].strip()
+    if langblob.startswith('lang:') or langblob.startswith('language:'):
+        return langblob.split(':', maxsplit=1)[1]
+    return None
+
+def parse_code_blocks(content: str) -> list[CodeBlock]:
+    # text and fenced code alternate, a `lang:x` inline block right before a fence overrides its language
+    parts = content.split('```')
+    blocks = []
+    for i in range(1, len(parts) - 1, 2):
+        code = parts[i]
+        lang = None
+        if '\n' in code and code[0].isalnum():
+            lang, code = code.split('\n', maxsplit=1)
+            lang = lang.strip()
+        override = lang_override(parts[i - 1])
+        if override is not None:
+            lang = override
+        blocks.append(CodeBlock(lang, code))
+    return blocks
@@ -0,0 +1,140 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import sqlite3
+import asyncio
+import shelve
+import queue
+import dbm
+import os
+
+class StorageBackend:
+    def load(self) -> list[tuple[int, str, str, str, int|None]]:
+        raise NotImplementedError()
+
+    async def put(self, language):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+class ShelveBackend(StorageBackend):
+    def __init__(self, path: str):
+        self.clients = shelve.open(path)
+        # shelve is not thread safe, a single worker keeps all writes in order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shelve-writer')
+
+    def load(self) -> list[tuple[int, str, str, str, int|None]]:
+        return [(lang.user_id, lang.name, lang.short, lang.key, lang.timeout_ms) for _, lang in self.clients.items()]
+
+    def write(self, language):
+        self.clients[str(language.user_id)] = language
+        self.clients.sync()
+
+    async def put(self, language):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.write, language)
+
+    def close(self):
+        self.executor.shutdown()
+        self.clients.close()
+
+def resolve(future: asyncio.Future, error: BaseException|None):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+class SQLiteBackend(StorageBackend):
+    def __init__(self, path: str, legacy_shelve: str|None = None):
+        self.path = path
+        conn = self.connect()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS languages (user_id INTEGER PRIMARY KEY, name TEXT NOT NULL, short TEXT NOT NULL, key TEXT NOT NULL, timeout_ms INTEGER)')
+            conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            # databases created before per language timeouts
+            if 'timeout_ms' not in [column[1] for column in conn.execute('PRAGMA table_info(languages)')]:
+                conn.execute('ALTER TABLE languages ADD COLUMN timeout_ms INTEGER')
+        if legacy_shelve is not None:
+            self.migrate(conn, legacy_shelve)
+        conn.close()
+        self.queue: queue.SimpleQueue = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self.write_loop, name='sqlite-writer', daemon=True)
+        self.writer.start()
+
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=FULL')
+        return conn
+
+    def migrate(self, conn: sqlite3.Connection, legacy_shelve: str):
+        if conn.execute('SELECT value FROM meta WHERE key = ?', ('migrated_shelve',)).fetchone() is not None:
+            return
+        if dbm.whichdb(legacy_shelve):
+            with shelve.open(legacy_shelve, flag='r') as clients:
+                languages = [lang for _, lang in clients.items()]
+            print(f'Migrating {len(languages)} languages from {legacy_shelve} to {self.path}')
+        else:
+            languages = []
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO languages VALUES (?, ?, ?, ?, ?)', [(lang.user_id, lang.name, lang.short, lang.key, lang.timeout_ms) for lang in languages])
+            conn.execute('INSERT INTO meta VALUES (?, ?)', ('migrated_shelve', legacy_shelve))
+
+    def load(self) -> list[tuple[int, str, str, str, int|None]]:
+        conn = self.connect()
+        rows = conn.execute('SELECT user_id, name, short, key, timeout_ms FROM languages').fetchall()
+        conn.close()
+        return rows
+
+    async def put(self, language):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put(((language.user_id, language.name, language.short, language.key, language.timeout_ms), loop, future))
+        await future
+
+    def write_loop(self):
+        conn = self.connect()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            # everything queued up while the last commit was flushing goes into a single transaction
+            batch = [item]
+            stop = False
+            while True:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            error = None
+            try:
+                with conn:
+                    conn.executemany('INSERT OR REPLACE INTO languages VALUES (?, ?, ?, ?, ?)', [row for row, _, _ in batch])
+            except Exception as e:
+                error = e
+            for _, loop, future in batch:
+                loop.call_soon_threadsafe(resolve, future, error)
+            if stop:
+                break
+        conn.close()
+
+    def close(self):
+        self.queue.put(None)
+        self.writer.join()
+
+def open_backend(kind: str, path: str, legacy_shelve: str|None = None) -> StorageBackend:
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    match kind:
+        case 'sqlite':
+            return SQLiteBackend(path, legacy_shelve)
+        case 'shelve':
+            return ShelveBackend(path)
+        case _:
+            raise ValueError(f'Unknown storage backend `{kind}`')
@@ -1,14 +1,59 @@
-import shelve
+from bisect import bisect_left, insort
+from typing import Iterator
+import hashlib
 import asyncio
+import time
 
 import config
+import metrics
+from storage import StorageBackend, open_backend
+
+def key_hash(key: str) -> bytes:
+    return hashlib.sha256(key.encode()).digest()
 
 class Language:
-    def __init__(self, user_id: int, name: str, short: str, key: str):
+    __slots__ = ('user_id', 'name', 'short', 'key', 'timeout_ms')
+
+    def __init__(self, user_id: int, name: str, short: str, key: str, timeout_ms: int|None = None):
         self.user_id = user_id
         self.name = name
         self.short = short
         self.key = key
+        # evaluation timeout set by the owner, None uses config.EVAL_TIMEOUT_MS
+        self.timeout_ms = timeout_ms
+
+    def __getstate__(self) -> dict:
+        return { slot: getattr(self, slot) for slot in Language.__slots__ }
+
+    def __setstate__(self, state):
+        # records pickled before Language had __slots__ store their attributes as a plain dict
+        if isinstance(state, tuple):
+            state = state[1]
+        for slot in Language.__slots__:
+            # records pickled before timeout_ms existed lack it
+            setattr(self, slot, state.get(slot))
+
+class PrefixIndex:
+    # sorted (term, name) pairs, the matches of a prefix are a contiguous run starting at its bisection point
+    def __init__(self):
+        self.entries: list[tuple[str, str]] = []
+
+    def add(self, term: str, name: str):
+        insort(self.entries, (term.lower(), name))
+
+    def remove(self, term: str, name: str):
+        entry = (term.lower(), name)
+        i = bisect_left(self.entries, entry)
+        if i < len(self.entries) and self.entries[i] == entry:
+            del self.entries[i]
+
+    def search(self, prefix: str) -> Iterator[str]:
+        prefix = prefix.lower()
+        for i in range(bisect_left(self.entries, (prefix,)), len(self.entries)):
+            term, name = self.entries[i]
+            if not term.startswith(prefix):
+                return
+            yield name
 
 class LanguageRegistrationException(Exception):
     def __init__(self, message: str):
@@ -16,34 +61,98 @@ class LanguageRegistrationException(Exception):
         self.message = message
 
 class Store:
-    def __init__(self):
+    def __init__(self, backend: StorageBackend|None = None):
         self.lock = asyncio.Lock()
-        self.clients: dict[str, Language] = shelve.open(config.CLIENTS_STORE)
+        if backend is None:
+            if config.STORE_BACKEND == 'shelve':
+                backend = open_backend('shelve', config.CLIENTS_STORE)
+            else:
+                backend = open_backend(config.STORE_BACKEND, config.CLIENTS_DB, legacy_shelve=config.CLIENTS_STORE)
+        self.backend = backend
+        # in-memory indexes, lookups never touch the backend
+        self.by_name: dict[str, Language] = {}
+        self.by_short: dict[str, Language] = {}
+        self.by_key: dict[bytes, Language] = {}
+        self.by_user: dict[int, Language] = {}
+        # names and shorts for autocomplete
+        self.prefixes = PrefixIndex()
+        for row in self.backend.load():
+            self.index(Language(*row))
+
+    def index(self, language: Language):
+        self.by_name[language.name] = language
+        self.by_short[language.short] = language
+        self.by_key[key_hash(language.key)] = language
+        self.by_user[language.user_id] = language
+        self.prefixes.add(language.name, language.name)
+        self.prefixes.add(language.short, language.name)
+
+    def unindex(self, language: Language):
+        if self.by_name.get(language.name) is language:
+            del self.by_name[language.name]
+        if self.by_short.get(language.short) is language:
+            del self.by_short[language.short]
+        hashed = key_hash(language.key)
+        if self.by_key.get(hashed) is language:
+            del self.by_key[hashed]
+        if self.by_user.get(language.user_id) is language:
+            del self.by_user[language.user_id]
+        self.prefixes.remove(language.name, language.name)
+        self.prefixes.remove(language.short, language.name)
 
     async def register_lang(self, language: Language) -> Language|None:
         async with self.lock:
-            for _, lang in self.clients.items():
-                if language.name == lang.name and lang.user_id != language.user_id:
-                    raise LanguageRegistrationException(f'A language with name {language.name} is alredy registered')
-                if language.short == lang.short and lang.user_id != language.user_id:
-                    raise LanguageRegistrationException(f'A language with name {language.short} is alredy registered')
-            old = None
-            if str(language.user_id) in self.clients:
-                old = self.clients[str(language.user_id)]
-            self.clients[str(language.user_id)] = language
-            self.clients.sync()
+            lang = self.by_name.get(language.name)
+            if lang is not None and lang.user_id != language.user_id:
+                raise LanguageRegistrationException(f'A language with name {language.name} is alredy registered')
+            lang = self.by_short.get(language.short)
+            if lang is not None and lang.user_id != language.user_id:
+                raise LanguageRegistrationException(f'A language with name {language.short} is alredy registered')
+            # the write is handed off to the backend, indexes only change once it is durable
+            await self.backend.put(language)
+            old = self.by_user.get(language.user_id)
+            if old is not None:
+                self.unindex(old)
+            self.index(language)
             return old
-    
-    async def find_lang(self, name: str) -> Language|None:
-        async with self.lock:
-            for _, lang in self.clients.items():
-                if name == lang.name or name == lang.short:
-                    return lang
-        return None
-    
-    async def validate_key(self, key: str) -> bool:
+
+    def find_lang(self, name: str) -> Language|None:
+        start = time.perf_counter()
+        lang = self.by_name.get(name)
+        if lang is None:
+            lang = self.by_short.get(name)
+        metrics.STORE_LOOKUP_SECONDS.observe(time.perf_counter() - start, 'find_lang')
+        return lang
+
+    def complete(self, prefix: str) -> list[Language]:
+        # languages whose name or short starts with prefix, ignoring case, ordered by name
+        start = time.perf_counter()
+        names = sorted(set(self.prefixes.search(prefix)))
+        metrics.STORE_LOOKUP_SECONDS.observe(time.perf_counter() - start, 'complete')
+        return [self.by_name[name] for name in names]
+
+    def find_by_user(self, user_id: int) -> Language|None:
+        return self.by_user.get(user_id)
+
+    async def set_timeout(self, user_id: int, timeout_ms: int|None) -> Language|None:
         async with self.lock:
-            for _, lang in self.clients.items():
-                if lang.key == key:
-                    return True
-        return False
\ No newline at end of file
+            old = self.by_user.get(user_id)
+            if old is None:
+                return None
+            language = Language(old.user_id, old.name, old.short, old.key, timeout_ms)
+            await self.backend.put(language)
+            self.unindex(old)
+            self.index(language)
+            return language
+
+    def find_by_key(self, key: str) -> Language|None:
+        start = time.perf_counter()
+        lang = self.by_key.get(key_hash(key))
+        metrics.STORE_LOOKUP_SECONDS.observe(time.perf_counter() - start, 'find_by_key')
+        return lang
+
+    def validate_key(self, key: str) -> bool:
+        return self.find_by_key(key) is not None
+
+    def close(self):
+        self.backend.close()